@@ -0,0 +1,351 @@
+""" Block Storage for Sampling Point Clouds
+
+Two on-disk layouts are supported:
+  - one `<block_name>.npy` file per block under `<data_path>/data/` (BlockStore)
+  - a packed container with all blocks in `<data_path>/blocks.bin` plus `<data_path>/blocks_index.npz` (PackedBlockStore)
+Both can be complemented by a label index (`label_index.bin` + `label_index.npz`) mapping (block, class) to the sorted
+indices of the points with that label, so that class-conditioned sampling does not scan the whole block.
+"""
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+PACKED_DATA_FILE = 'blocks.bin'
+PACKED_INDEX_FILE = 'blocks_index.npz'
+# one record per point: 012 XYZ in meters, 345 RGB in [0,255], 6 the label
+PACKED_DTYPE = np.dtype([('xyz', '<f4', (3,)), ('rgb', 'u1', (3,)), ('label', '<i2')])
+LABEL_INDEX_DATA_FILE = 'label_index.bin'
+LABEL_INDEX_FILE = 'label_index.npz'
+
+
+def records2points(records):
+    """Convert packed point records into a (num_points, 7) float32 array"""
+    data = np.empty((records.shape[0], 7), dtype=np.float32)
+    data[:, 0:3] = records['xyz']
+    data[:, 3:6] = records['rgb']
+    data[:, 6] = records['label']
+    return data
+
+
+def open_block_store(data_path, cache_size=0):
+    """Open the packed container if `data_path` has one, otherwise fall back to the per-block npy files."""
+    if os.path.exists(os.path.join(data_path, PACKED_INDEX_FILE)):
+        return PackedBlockStore(data_path)
+    return BlockStore(data_path, cache_size=cache_size)
+
+
+class BaseBlockStore(object):
+    """
+    Common interface of the block stores, subclasses implement open(), labels() and gather().
+    The reads of one block accept the `block` returned by open(), so that sampling a block opens it only once.
+    """
+    def __init__(self, data_path):
+        self.data_path = data_path
+        if os.path.exists(os.path.join(data_path, LABEL_INDEX_FILE)):
+            self.label_index = LabelIndex(data_path)
+        else:
+            self.label_index = None
+        self.block_indexed = {}
+        self.warned_unindexed = False
+
+    def open(self, block_name):
+        """Open one block for several reads, the result is only meant to be passed back to this store"""
+        raise NotImplementedError
+
+    def num_points(self, block_name, block=None):
+        return self.labels(block_name, block).shape[0]
+
+    def manifest(self):
+        """Cheap signature of the set of blocks, which changes when blocks are added, removed or replaced"""
+        raise NotImplementedError
+
+    def is_indexed(self, block_name):
+        """
+        True if the label index covers the block and still matches it, i.e. has the same number of points.
+        The check is done once per block, other blocks (e.g. added or rewritten after the index was built) are
+        scanned until the index is rebuilt.
+        """
+        if self.label_index is None:
+            return False
+        if block_name not in self.block_indexed:
+            indexed = block_name in self.label_index and \
+                      self.label_index.num_points(block_name) == self.num_points(block_name)
+            if not indexed and not self.warned_unindexed:
+                print('Warning: some blocks (e.g. %s) are missing from the label index of %s or do not match it, '
+                      'their labels are scanned until the index is rebuilt' % (block_name, self.data_path))
+                self.warned_unindexed = True
+            self.block_indexed[block_name] = indexed
+        return self.block_indexed[block_name]
+
+    def class_point_inds(self, block_name, class_id, block=None):
+        """Return the sorted indices of the points of one block labelled as `class_id`"""
+        if self.is_indexed(block_name):
+            return self.label_index.point_inds(block_name, class_id)
+        return np.nonzero(self.labels(block_name, block) == class_id)[0]
+
+
+class BlockStore(BaseBlockStore):
+    """
+    Read-only access to the block files `<data_path>/data/<block_name>.npy`.
+    Blocks are opened with memory mapping so that sampling a few thousand points only pages in the touched rows,
+    and an optional bounded LRU keeps the most recently used blocks decoded in memory across episodes.
+    Parameters:
+      data_path: directory containing the `data` folder of blocks
+      cache_size: max number of decoded blocks kept in the LRU, 0 disables caching
+      mmap: if True, open the uncached blocks with np.load(mmap_mode='r'), otherwise decode them into memory
+    """
+    def __init__(self, data_path, cache_size=0, mmap=True):
+        super(BlockStore, self).__init__(data_path)
+        self.cache_size = cache_size
+        self.mmap = mmap
+        self.cache = OrderedDict()
+
+    def __getstate__(self):
+        # do not ship opened/decoded blocks to dataloader workers
+        state = self.__dict__.copy()
+        state['cache'] = OrderedDict()
+        return state
+
+    def block_names(self):
+        return sorted(os.path.basename(f)[:-4] for f in os.listdir(os.path.join(self.data_path, 'data'))
+                      if f.endswith('.npy'))
+
+    def block_file(self, block_name):
+        return os.path.join(self.data_path, 'data', '%s.npy' % block_name)
+
+    def manifest(self):
+        # one listing and one stat of the data folder, whose mtime changes when a block file is created or renamed
+        data_dir = os.path.join(self.data_path, 'data')
+        return len(self.block_names()), os.path.getmtime(data_dir)
+
+    def load(self, block_name):
+        """
+        Return the block as a (num_points, 7) array, 012 are XYZ, 345 are RGB, 6 is the label.
+        The returned array may be memory mapped or shared with the cache, so it must not be modified in place.
+        """
+        if block_name in self.cache:
+            self.cache.move_to_end(block_name)
+            return self.cache[block_name]
+
+        if self.cache_size > 0:
+            # a cached block is decoded once, caching a memory map would not save any read
+            data = np.load(self.block_file(block_name))
+            self.cache[block_name] = data
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+            return data
+        return np.load(self.block_file(block_name), mmap_mode='r' if self.mmap else None)
+
+    def open(self, block_name):
+        return self.load(block_name)
+
+    def num_points(self, block_name, block=None):
+        if block is None:
+            # only the npy header is read, the block is not decoded into the cache
+            block = self.cache.get(block_name)
+            if block is None:
+                block = np.load(self.block_file(block_name), mmap_mode='r')
+        return block.shape[0]
+
+    def labels(self, block_name, block=None):
+        """Return the per-point labels of one block, shape: (num_points,)"""
+        if block is None:
+            block = self.open(block_name)
+        return block[:, 6]
+
+    def gather(self, block_name, point_inds, block=None):
+        """Return the selected points of one block as a new (len(point_inds), 7) array"""
+        if block is None:
+            block = self.open(block_name)
+        return np.asarray(block[point_inds])
+
+
+class PackedBlockStore(BaseBlockStore):
+    """
+    Read-only access to a packed block container written by PackedBlockWriter.
+    All points live in one memory-mapped record file; each block is a contiguous slice given by the
+    offsets/counts index, so reading labels is zero-copy and only the sampled points are gathered.
+    Parameters:
+      data_path: directory containing `blocks.bin` and `blocks_index.npz`
+    """
+    def __init__(self, data_path):
+        super(PackedBlockStore, self).__init__(data_path)
+        index = np.load(os.path.join(data_path, PACKED_INDEX_FILE))
+        self.names = [str(name) for name in index['names']]
+        self.offsets = index['offsets']
+        self.counts = index['counts']
+        self.class_hist = index['class_hist']  # (num_blocks, num_classes)
+        self.name2row = {name: i for i, name in enumerate(self.names)}
+        self.points = None
+
+    def __getstate__(self):
+        # the memory map is re-opened lazily in each dataloader worker
+        state = self.__dict__.copy()
+        state['points'] = None
+        return state
+
+    def _records(self, block_name):
+        if self.points is None:
+            self.points = np.memmap(os.path.join(self.data_path, PACKED_DATA_FILE), dtype=PACKED_DTYPE, mode='r')
+        row = self.name2row[block_name]
+        offset = self.offsets[row]
+        return self.points[offset:offset+self.counts[row]]
+
+    def block_names(self):
+        return list(self.names)
+
+    def manifest(self):
+        # the index is written last, when the container is complete
+        return len(self.names), os.path.getmtime(os.path.join(self.data_path, PACKED_INDEX_FILE))
+
+    def open(self, block_name):
+        return self._records(block_name)
+
+    def num_points(self, block_name, block=None):
+        return int(self.counts[self.name2row[block_name]])
+
+    def load(self, block_name):
+        return records2points(self._records(block_name))
+
+    def labels(self, block_name, block=None):
+        if block is None:
+            block = self.open(block_name)
+        return block['label']
+
+    def gather(self, block_name, point_inds, block=None):
+        if block is None:
+            block = self.open(block_name)
+        return records2points(block[point_inds])
+
+
+class PackedBlockWriter(object):
+    """
+    Append blocks to a packed container, see PackedBlockStore.
+    The index (names, offsets, counts and per-block class histogram) is written on close().
+    """
+    def __init__(self, out_path):
+        self.out_path = out_path
+        self.f = open(os.path.join(out_path, PACKED_DATA_FILE), 'wb')
+        self.names = []
+        self.counts = []
+        self.class_hists = []
+
+    def add(self, block_name, data):
+        """
+        Args:
+            block_name: name of the block, e.g. <room>_block_<i>
+            data: N x 7 numpy array, 012 are XYZ in meters, 345 are RGB in [0,255], 6 is the labels
+        """
+        records = np.empty(data.shape[0], dtype=PACKED_DTYPE)
+        records['xyz'] = data[:, 0:3]
+        records['rgb'] = data[:, 3:6]
+        records['label'] = data[:, 6]
+        records.tofile(self.f)
+
+        self.names.append(block_name)
+        self.counts.append(data.shape[0])
+        self.class_hists.append(np.bincount(records['label'].astype(np.int64)))
+
+    def close(self):
+        self.f.close()
+        num_classes = max([len(h) for h in self.class_hists] + [0])
+        class_hist = np.zeros((len(self.class_hists), num_classes), dtype=np.int64)
+        for i, h in enumerate(self.class_hists):
+            class_hist[i, :len(h)] = h
+        counts = np.array(self.counts, dtype=np.int64)
+        offsets = np.cumsum(counts) - counts
+        np.savez(os.path.join(self.out_path, PACKED_INDEX_FILE), names=np.array(self.names), offsets=offsets,
+                 counts=counts, class_hist=class_hist)
+
+
+class LabelIndex(object):
+    """
+    Read-only (block, class) -> point indices table written by LabelIndexWriter.
+    The point indices of each block are stored grouped by class in one memory-mapped int32 file,
+    `class_offsets[row, c]:class_offsets[row, c+1]` delimits the points of class c inside the block.
+    """
+    def __init__(self, data_path):
+        self.data_path = data_path
+        index = np.load(os.path.join(data_path, LABEL_INDEX_FILE))
+        self.mtime = os.path.getmtime(os.path.join(data_path, LABEL_INDEX_FILE))
+        self.name2row = {str(name): i for i, name in enumerate(index['names'])}
+        self.offsets = index['offsets']
+        self.class_offsets = index['class_offsets']  # (num_blocks, num_classes+1)
+        self.point_inds_all = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['point_inds_all'] = None
+        return state
+
+    def __contains__(self, block_name):
+        return block_name in self.name2row
+
+    def class_counts(self, block_name):
+        """Number of points per class in one block, shape: (num_classes,)"""
+        return np.diff(self.class_offsets[self.name2row[block_name]])
+
+    def num_points(self, block_name):
+        """Number of points of one block when the index was built"""
+        return int(self.class_offsets[self.name2row[block_name], -1])
+
+    def point_inds(self, block_name, class_id):
+        """Sorted indices of the points of class `class_id` in one block, the block must be indexed"""
+        if self.point_inds_all is None:
+            self.point_inds_all = np.memmap(os.path.join(self.data_path, LABEL_INDEX_DATA_FILE), dtype='<i4',
+                                            mode='r')
+        row = self.name2row[block_name]
+        class_id = int(class_id)
+        if class_id < 0 or class_id >= self.class_offsets.shape[1] - 1:
+            return np.zeros(0, dtype=np.int32)
+        start = self.offsets[row] + self.class_offsets[row, class_id]
+        end = self.offsets[row] + self.class_offsets[row, class_id+1]
+        return self.point_inds_all[start:end]
+
+
+class LabelIndexWriter(object):
+    """
+    Append the labels of each block to a label index, see LabelIndex.
+    The offsets are written on close().
+    """
+    def __init__(self, out_path):
+        self.out_path = out_path
+        self.f = open(os.path.join(out_path, LABEL_INDEX_DATA_FILE), 'wb')
+        self.names = []
+        self.class_counts = []
+
+    def add(self, block_name, labels):
+        """
+        Args:
+            block_name: name of the block, e.g. <room>_block_<i>
+            labels: per-point labels of the block, shape: (num_points,)
+        """
+        labels = np.asarray(labels).astype(np.int64)
+        # a stable sort keeps the point indices of each class in ascending order
+        np.argsort(labels, kind='stable').astype('<i4').tofile(self.f)
+        self.names.append(block_name)
+        self.class_counts.append(np.bincount(labels))
+
+    def close(self):
+        self.f.close()
+        num_classes = max([len(c) for c in self.class_counts] + [0])
+        class_offsets = np.zeros((len(self.class_counts), num_classes+1), dtype=np.int64)
+        for i, c in enumerate(self.class_counts):
+            class_offsets[i, 1:len(c)+1] = np.cumsum(c)
+            class_offsets[i, len(c)+1:] = class_offsets[i, len(c)]
+        counts = class_offsets[:, -1]
+        offsets = np.cumsum(counts) - counts
+        np.savez(os.path.join(self.out_path, LABEL_INDEX_FILE), names=np.array(self.names), offsets=offsets,
+                 class_offsets=class_offsets)
+
+
+def build_label_index(block_store, out_path=None):
+    """Build the label index of every block in `block_store`, written next to the blocks by default"""
+    if out_path is None:
+        out_path = block_store.data_path
+    writer = LabelIndexWriter(out_path)
+    for block_name in block_store.block_names():
+        writer.add(block_name, block_store.labels(block_name))
+    writer.close()
+    block_store.label_index = LabelIndex(out_path)
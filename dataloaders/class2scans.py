@@ -0,0 +1,116 @@
+""" Build the class -> scans mapping shared by the S3DIS and ScanNet datasets
+
+The mapping is saved to `<data_path>/class2scans.pkl` (`class2scans_<min_ratio>_<min_pts>.pkl` for non-default
+thresholds) with a manifest of the block store and the label index, and reused as long as the manifest matches
+(see BaseBlockStore.manifest, no block file is stat-ed). Otherwise it is derived from per-block class histograms,
+which are cached in `<data_path>/class_hist.pkl` and keyed on the mtime/size of each block file. Changing
+min_ratio/min_pts only re-filters the histograms, and adding new scenes only scans the new (or modified) blocks.
+"""
+import os
+import pickle
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+
+CLASS_HIST_FILE = 'class_hist.pkl'
+CLASS2SCANS_FILE = 'class2scans.pkl'
+
+
+def compute_block_class_hist(block_store, block_name):
+    """Number of points per class in one block, shape: (max_label+1,)"""
+    if block_store.is_indexed(block_name):
+        return block_store.label_index.class_counts(block_name)
+    return np.bincount(np.asarray(block_store.labels(block_name)).astype(np.int64))
+
+
+def get_block_class_hists(block_store, n_workers=None):
+    """
+    Return {block_name: class histogram} for every block in `block_store`.
+    Blocks whose file is unchanged since the last call are served from the cache, the others are scanned
+    with a process pool of `n_workers` (defaults to the number of cpus).
+    """
+    block_names = block_store.block_names()
+    if getattr(block_store, 'class_hist', None) is not None:
+        # the packed container keeps the histograms in its index
+        return {name: block_store.class_hist[block_store.name2row[name]] for name in block_names}
+
+    cache_file = os.path.join(block_store.data_path, CLASS_HIST_FILE)
+    if os.path.exists(cache_file):
+        with open(cache_file, 'rb') as f:
+            cache = pickle.load(f)
+    else:
+        cache = {}
+
+    class_hists = {}
+    signatures = {}
+    todo = []
+    for block_name in block_names:
+        stat = os.stat(block_store.block_file(block_name))
+        signatures[block_name] = (stat.st_mtime, stat.st_size)
+        if block_name in cache and cache[block_name][0] == signatures[block_name]:
+            class_hists[block_name] = cache[block_name][1]
+        else:
+            todo.append(block_name)
+
+    if len(todo) > 0:
+        print('Computing class histograms of {0}/{1} blocks...'.format(len(todo), len(block_names)))
+        if n_workers is None:
+            n_workers = os.cpu_count()
+        compute_fn = partial(compute_block_class_hist, block_store)
+        if n_workers > 1:
+            pool = Pool(n_workers)
+            new_hists = pool.map(compute_fn, todo, chunksize=max(1, len(todo) // (n_workers*4)))
+            pool.close()
+            pool.join()
+        else:
+            new_hists = [compute_fn(block_name) for block_name in todo]
+        class_hists.update(zip(todo, new_hists))
+
+        cache = {name: (signatures[name], class_hists[name]) for name in block_names}
+        with open(cache_file, 'wb') as f:
+            pickle.dump(cache, f, pickle.HIGHEST_PROTOCOL)
+
+    return class_hists
+
+
+def filter_class2scans(class_hists, num_classes, min_ratio=.05, min_pts=100):
+    """
+    Keep a block for a class only if it has more than max(num_points*min_ratio, min_pts) points of that class
+    :return: class2scans, {class_id: [block_name, ...]}
+    """
+    class2scans = {k: [] for k in range(num_classes)}
+    for block_name in sorted(class_hists):
+        class_hist = class_hists[block_name]
+        threshold = max(int(class_hist.sum()*min_ratio), min_pts)
+        for class_id in np.nonzero(class_hist > threshold)[0]:
+            class2scans[int(class_id)].append(block_name)
+    return class2scans
+
+
+def class2scans_file(data_path, min_ratio=.05, min_pts=100):
+    if min_ratio == .05 and min_pts == 100:
+        return os.path.join(data_path, CLASS2SCANS_FILE)
+    return os.path.join(data_path, 'class2scans_%g_%d.pkl' % (min_ratio, min_pts))
+
+
+def build_class2scans(block_store, num_classes, min_ratio=.05, min_pts=100, n_workers=None):
+    """
+    Return the class2scans mapping of `block_store`, loaded from its pickle if the manifest saved with it still
+    matches the block store and the label index, otherwise rebuilt from the class histograms and saved
+    """
+    out_file = class2scans_file(block_store.data_path, min_ratio=min_ratio, min_pts=min_pts)
+    label_index = block_store.label_index
+    manifest = (block_store.manifest(), None if label_index is None else label_index.mtime)
+    if os.path.exists(out_file):
+        with open(out_file, 'rb') as f:
+            saved = pickle.load(f)
+        # mappings pickled without a manifest (older versions) cannot be validated and are rebuilt
+        if isinstance(saved, dict) and saved.get('manifest') == manifest:
+            return saved['class2scans']
+
+    class_hists = get_block_class_hists(block_store, n_workers=n_workers)
+    class2scans = filter_class2scans(class_hists, num_classes, min_ratio=min_ratio, min_pts=min_pts)
+    with open(out_file, 'wb') as f:
+        pickle.dump({'manifest': manifest, 'class2scans': class2scans}, f, pickle.HIGHEST_PROTOCOL)
+    return class2scans
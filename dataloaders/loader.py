@@ -2,9 +2,15 @@
 
 """
 import os
+import copy
 import random
 import math
 import glob
+import time
+import shutil
+import hashlib
+import threading
+import multiprocessing
 import numpy as np
 import h5py as h5
 import transforms3d
@@ -13,14 +19,16 @@ from itertools import  combinations
 import torch
 from torch.utils.data import Dataset
 
+from dataloaders.block_store import open_block_store
 
-def sample_K_pointclouds(data_path, num_point, pc_attribs, pc_augm, pc_augm_config,
+
+def sample_K_pointclouds(block_store, num_point, pc_attribs, pc_augm, pc_augm_config,
                          scan_names, sampled_class, sampled_classes, is_support=False):
     '''sample K pointclouds and the corresponding labels for one class (one_way)'''
     ptclouds  = []
     labels = []
     for scan_name in scan_names:
-        ptcloud, label = sample_pointcloud(data_path, num_point, pc_attribs, pc_augm, pc_augm_config,
+        ptcloud, label = sample_pointcloud(block_store, num_point, pc_attribs, pc_augm, pc_augm_config,
                                            scan_name, sampled_classes, sampled_class, support=is_support)
         ptclouds.append(ptcloud)
         labels.append(label)
@@ -33,17 +41,18 @@ def sample_K_pointclouds(data_path, num_point, pc_attribs, pc_augm, pc_augm_conf
     return ptclouds, labels
 
 
-def sample_pointcloud(data_path, num_point, pc_attribs, pc_augm, pc_augm_config, scan_name,
+def sample_pointcloud(block_store, num_point, pc_attribs, pc_augm, pc_augm_config, scan_name,
                       sampled_classes, sampled_class=0, support=False, random_sample=False):
     sampled_classes = list(sampled_classes)
-    data = np.load(os.path.join(data_path, 'data', '%s.npy' %scan_name))
-    N = data.shape[0] #number of points in this scan
+    # the block is opened (memory mapped) once and shared by all the reads below
+    block = block_store.open(scan_name)
+    N = block_store.num_points(scan_name, block) #number of points in this scan
 
     if random_sample:
-        sampled_point_inds = np.random.choice(np.arange(N), num_point, replace=(N < num_point))
+        sampled_point_inds = sample_inds(N, num_point, replace=(N < num_point))
     else:
         # If this point cloud is for support/query set, make sure that the sampled points contain target class
-        valid_point_inds = np.nonzero(data[:,6] == sampled_class)[0]  # indices of points belonging to the sampled class
+        valid_point_inds = block_store.class_point_inds(scan_name, sampled_class, block)  # indices of points belonging to the sampled class
 
         if N < num_point:
             sampled_valid_point_num = len(valid_point_inds)
@@ -51,16 +60,50 @@ def sample_pointcloud(data_path, num_point, pc_attribs, pc_augm, pc_augm_config,
             valid_ratio = len(valid_point_inds)/float(N)
             sampled_valid_point_num = int(valid_ratio*num_point)
 
-        sampled_valid_point_inds = np.random.choice(valid_point_inds, sampled_valid_point_num, replace=False)
-        sampled_other_point_inds = np.random.choice(np.arange(N), num_point-sampled_valid_point_num,
-                                                    replace=(N<num_point))
+        sampled_valid_point_inds = valid_point_inds[sample_inds(len(valid_point_inds), sampled_valid_point_num)]
+        sampled_other_point_inds = sample_inds(N, num_point-sampled_valid_point_num, replace=(N<num_point))
         sampled_point_inds = np.concatenate([sampled_valid_point_inds, sampled_other_point_inds])
 
-    data = data[sampled_point_inds]
+    data = block_store.gather(scan_name, sampled_point_inds, block)
     xyz = data[:, 0:3]
     rgb = data[:, 3:6]
     labels = data[:,6].astype(np.int)
 
+    ptcloud = build_pointcloud(xyz, rgb/255., pc_attribs, pc_augm, pc_augm_config)
+
+    if support:
+        groundtruth = labels==sampled_class
+    else:
+        groundtruth = remap_labels(labels, sampled_classes)
+
+    return ptcloud, groundtruth
+
+
+def sample_inds(n, size, replace=False):
+    """
+    Draw `size` indices in [0, n) with the global numpy RNG, without replacement unless `replace`.
+    Unlike np.random.choice(n, size, replace=False), which permutes all the n indices, distinct indices are
+    rejection sampled so that the cost is proportional to `size` when it is small compared to n.
+    """
+    if replace:
+        return np.random.randint(0, n, size)
+    if size > n // 2:
+        return np.random.permutation(n)[:size]
+    inds = np.zeros(0, dtype=np.int64)
+    while len(inds) < size:
+        inds = np.unique(np.concatenate([inds, np.random.randint(0, n, size - len(inds) + size // 8 + 1)]))
+    # the distinct draws are exchangeable, a random subset of them is a uniform sample without replacement
+    np.random.shuffle(inds)
+    return inds[:size]
+
+
+def build_pointcloud(xyz, rgb, pc_attribs, pc_augm, pc_augm_config):
+    """
+    Assemble the point attributes fed to the network, xyz is shifted to the origin and optionally augmented
+    :param xyz: (num_point, 3) coordinates, modified in place
+    :param rgb: (num_point, 3) colors in [0,1]
+    :return: ptcloud: (num_point, len(pc_attribs))
+    """
     xyz_min = np.amin(xyz, axis=0)
     xyz -= xyz_min
     if pc_augm:
@@ -73,19 +116,26 @@ def sample_pointcloud(data_path, num_point, pc_attribs, pc_augm, pc_augm_config,
 
     ptcloud = []
     if 'xyz' in pc_attribs: ptcloud.append(xyz)
-    if 'rgb' in pc_attribs: ptcloud.append(rgb/255.)
+    if 'rgb' in pc_attribs: ptcloud.append(rgb)
     if 'XYZ' in pc_attribs: ptcloud.append(XYZ)
     ptcloud = np.concatenate(ptcloud, axis=1)
+    return ptcloud
 
-    if support:
-        groundtruth = labels==sampled_class
-    else:
-        groundtruth = np.zeros_like(labels)
-        for i, label in enumerate(labels):
-            if label in sampled_classes:
-                groundtruth[i] = sampled_classes.index(label)+1
 
-    return ptcloud, groundtruth
+def remap_labels(labels, classes):
+    """
+    Relabel with a look-up table: a point labelled as classes[i] gets label i+1, any other point gets 0 (background)
+    :param labels: np array of non-negative integer labels with any shape
+    :param classes: list of classes, e.g. the sampled classes of one episode
+    :return: np array (int64) with the same shape as labels
+    """
+    labels = np.asarray(labels)
+    if labels.size == 0:
+        return np.zeros(labels.shape, dtype=np.int64)
+    classes = np.asarray(classes, dtype=np.int64)
+    lut = np.zeros(max(int(np.max(labels)), int(np.max(classes, initial=0))) + 1, dtype=np.int64)
+    lut[classes] = np.arange(1, len(classes)+1)
+    return lut[labels]
 
 
 def augment_pointcloud(P, pc_augm_config):
@@ -112,9 +162,12 @@ def augment_pointcloud(P, pc_augm_config):
 
 class MyDataset(Dataset):
     def __init__(self, data_path, dataset_name, cvfold=0, num_episode=50000, n_way=3, k_shot=5, n_queries=1,
-                 phase=None, mode='train', num_point=4096, pc_attribs='xyz', pc_augm=False, pc_augm_config=None):
+                 phase=None, mode='train', num_point=4096, pc_attribs='xyz', pc_augm=False, pc_augm_config=None,
+                 block_cache_size=0):
         super(MyDataset).__init__()
         self.data_path = data_path
+        self.block_store = open_block_store(data_path, cache_size=block_cache_size)
+        self.cvfold = cvfold
         self.n_way = n_way
         self.k_shot = k_shot
         self.n_queries = n_queries
@@ -128,10 +181,10 @@ class MyDataset(Dataset):
 
         if dataset_name == 's3dis':
             from dataloaders.s3dis import S3DISDataset
-            self.dataset = S3DISDataset(cvfold, data_path)
+            self.dataset = S3DISDataset(cvfold, data_path, block_store=self.block_store)
         elif dataset_name == 'scannet':
             from dataloaders.scannet import ScanNetDataset
-            self.dataset = ScanNetDataset(cvfold, data_path)
+            self.dataset = ScanNetDataset(cvfold, data_path, block_store=self.block_store)
         else:
             raise NotImplementedError('Unknown dataset %s!' % dataset_name)
 
@@ -145,6 +198,12 @@ class MyDataset(Dataset):
         print('MODE: {0} | Classes: {1}'.format(mode, self.classes))
         self.class2scans = self.dataset.class2scans
 
+        # integer-indexed scan table: class -> rows of self.scan_names (in class2scans order)
+        self.scan_names = np.array(sorted(set(name for scans in self.class2scans.values() for name in scans)))
+        self.scan2row = {name: row for row, name in enumerate(self.scan_names)}
+        self.class2rows = {c: np.array([self.scan2row[name] for name in scans], dtype=np.int64)
+                           for c, scans in self.class2scans.items()}
+
     def __len__(self):
         return self.num_episode
 
@@ -188,17 +247,18 @@ class MyDataset(Dataset):
         query_ptclouds = []
         query_labels = []
 
-        black_list = []  # to store the sampled scan names, in order to prevent sampling one scan several times...
+        # mask of the sampled scans, in order to prevent sampling one scan several times...
+        black_list = np.zeros(len(self.scan_names), dtype=bool)
         for sampled_class in sampled_classes:
-            all_scannames = self.class2scans[sampled_class].copy()
-            if len(black_list) != 0:
-                all_scannames = [x for x in all_scannames if x not in black_list]
-            selected_scannames = np.random.choice(all_scannames, self.k_shot+self.n_queries, replace=False)
-            black_list.extend(selected_scannames)
+            all_scanrows = self.class2rows[sampled_class]
+            all_scanrows = all_scanrows[~black_list[all_scanrows]]
+            selected_scanrows = np.random.choice(all_scanrows, self.k_shot+self.n_queries, replace=False)
+            black_list[selected_scanrows] = True
+            selected_scannames = self.scan_names[selected_scanrows]
             query_scannames = selected_scannames[:self.n_queries]
             support_scannames = selected_scannames[self.n_queries:]
 
-            query_ptclouds_one_way, query_labels_one_way = sample_K_pointclouds(self.data_path, self.num_point,
+            query_ptclouds_one_way, query_labels_one_way = sample_K_pointclouds(self.block_store, self.num_point,
                                                                                 self.pc_attribs, self.pc_augm,
                                                                                 self.pc_augm_config,
                                                                                 query_scannames,
@@ -206,7 +266,7 @@ class MyDataset(Dataset):
                                                                                 sampled_classes,
                                                                                 is_support=False)
 
-            support_ptclouds_one_way, support_masks_one_way = sample_K_pointclouds(self.data_path, self.num_point,
+            support_ptclouds_one_way, support_masks_one_way = sample_K_pointclouds(self.block_store, self.num_point,
                                                                                 self.pc_attribs, self.pc_augm,
                                                                                 self.pc_augm_config,
                                                                                 support_scannames,
@@ -227,6 +287,16 @@ class MyDataset(Dataset):
         return support_ptclouds, support_masks, query_ptclouds, query_labels
 
 
+def episode_worker_init_fn(worker_id):
+    """
+    Seed numpy and random in each dataloader worker, otherwise every worker inherits the RNG state of the main
+    process and generates the same episodes. torch already gives each worker its own seed (base_seed + worker_id).
+    """
+    seed = torch.initial_seed() % 2**32
+    np.random.seed(seed)
+    random.seed(seed)
+
+
 def batch_train_task_collate(batch):
     task_train_support_ptclouds, task_train_support_masks, task_train_query_ptclouds, task_train_query_labels, \
     task_valid_support_ptclouds, task_valid_support_masks, task_valid_query_ptclouds, task_valid_query_labels = list(zip(*batch))
@@ -248,11 +318,119 @@ def batch_train_task_collate(batch):
     return data
 
 
+############################################## Episode Cache for Training ##############################################
+
+def episode_cache_key(dataset):
+    """Short hash of the settings of a MyDataset that an episode cache was generated with"""
+    config = [dataset.cvfold, dataset.n_way, dataset.k_shot, dataset.n_queries, dataset.num_point, dataset.mode,
+              [int(c) for c in dataset.classes], dataset.pc_attribs, bool(dataset.pc_augm),
+              sorted((dataset.pc_augm_config or {}).items())]
+    return hashlib.sha1(repr(config).encode()).hexdigest()[:10]
+
+
+class MyEpisodeCacheDataset(Dataset):
+    """
+    Replay a pool of pre-generated training episodes instead of sampling every episode from the blocks.
+    The pool stores the sampled (unaugmented) xyz/rgb of each cloud in memory-mapped npy files under
+    `<data_path>/S_<cvfold>_N_<n_way>_K_<k_shot>_Q_<n_queries>_cache_episodes_<n>_pts_<num_point>_<key>`, where key
+    hashes the whole sampling configuration (see episode_cache_key); episodes are cycled through and only the point attributes and the augmentation are computed online.
+    Parameters:
+      dataset: the MyDataset used to generate the pool, its pc_attribs/pc_augm settings are applied on replay
+      num_cached_episode: number of episodes in the pool
+    """
+    FIELDS = ['support_points', 'support_masks', 'query_points', 'query_labels', 'sampled_classes']
+
+    def __init__(self, dataset, num_cached_episode):
+        super(MyEpisodeCacheDataset).__init__()
+        if dataset.phase == 'metatrain':
+            raise NotImplementedError('Episode cache does not support the metatrain phase!')
+        self.num_episode = dataset.num_episode
+        self.num_cached_episode = num_cached_episode
+        self.classes = dataset.classes
+        self.pc_attribs = dataset.pc_attribs
+        self.pc_augm = dataset.pc_augm
+        self.pc_augm_config = dataset.pc_augm_config
+
+        self.cache_path = os.path.join(dataset.data_path, 'S_%d_N_%d_K_%d_Q_%d_cache_episodes_%d_pts_%d_%s' % (
+                                       dataset.cvfold, dataset.n_way, dataset.k_shot, dataset.n_queries,
+                                       num_cached_episode, dataset.num_point, episode_cache_key(dataset)))
+        if not os.path.exists(self.cache_path):
+            self.build_cache(dataset)
+        self.cache = None
+
+    def build_cache(self, dataset):
+        print('Episode cache (%s) does not exist...\n Constructing...' % self.cache_path)
+        # keep raw xyz and normalized rgb so that attributes and augmentation can be recomputed on replay
+        raw_dataset = copy.copy(dataset)
+        raw_dataset.pc_attribs = 'xyzrgb'
+        raw_dataset.pc_augm = False
+
+        tmp_path = self.cache_path + '.tmp'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.mkdir(tmp_path)
+
+        cache = None
+        for i in range(self.num_cached_episode):
+            episode = raw_dataset.__getitem__(i)
+            if cache is None:
+                cache = [np.lib.format.open_memmap(os.path.join(tmp_path, '%s.npy' % field), mode='w+',
+                                                   dtype=data.dtype, shape=(self.num_cached_episode,)+data.shape)
+                         for field, data in zip(self.FIELDS, episode)]
+            for field_cache, data in zip(cache, episode):
+                field_cache[i] = data
+            if (i+1) % 1000 == 0:
+                print('\t {0}/{1} episodes cached'.format(i+1, self.num_cached_episode))
+
+        for field_cache in cache:
+            field_cache.flush()
+        del cache
+        # the pool only becomes visible once it is complete
+        os.rename(tmp_path, self.cache_path)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['cache'] = None
+        return state
+
+    def __len__(self):
+        return self.num_episode
+
+    def __getitem__(self, index):
+        if self.cache is None:
+            self.cache = [np.load(os.path.join(self.cache_path, '%s.npy' % field), mmap_mode='r')
+                          for field in self.FIELDS]
+        support_points, support_masks, query_points, query_labels, sampled_classes = \
+            [np.array(field_cache[index % self.num_cached_episode]) for field_cache in self.cache]
+
+        support_ptclouds = np.stack([self.build_ptcloud(points) for points in support_points.reshape(
+                                    (-1,)+support_points.shape[-2:])], axis=0)
+        support_ptclouds = support_ptclouds.reshape(support_points.shape[:-1]+(-1,))
+        query_ptclouds = np.stack([self.build_ptcloud(points) for points in query_points], axis=0)
+
+        return support_ptclouds.astype(np.float32), \
+               support_masks, \
+               query_ptclouds.astype(np.float32), \
+               query_labels, \
+               sampled_classes
+
+    def build_ptcloud(self, points):
+        return build_pointcloud(points[:, 0:3], points[:, 3:6], self.pc_attribs, self.pc_augm, self.pc_augm_config)
+
+
 ################################################ Static Testing Dataset ################################################
 
 class MyTestDataset(Dataset):
+    """
+    Static episodes for validation/testing, stored in one EpisodeArchive (`<test_data_path>.h5`) per configuration.
+    Missing episodes are generated by a pool of `n_workers` processes with a fixed seed per episode, derived from
+    `seed`, the archive name (so validation and test episodes of one configuration are drawn independently) and the
+    episode index, so an interrupted construction resumes with identical episodes. Construction runs in the background and
+    __getitem__ waits only for the requested episode, so evaluation starts as soon as the first episodes exist.
+    Folders with one h5 file per episode generated by older versions are still read.
+    """
     def __init__(self, data_path, dataset_name, cvfold=0, num_episode_per_comb=100, n_way=3, k_shot=5, n_queries=1,
-                       num_point=4096, pc_attribs='xyz', mode='valid'):
+                       num_point=4096, pc_attribs='xyz', mode='valid', n_workers=0, seed=0, compression=None):
         super(MyTestDataset).__init__()
 
         dataset = MyDataset(data_path, dataset_name, cvfold=cvfold, n_way=n_way, k_shot=k_shot, n_queries=n_queries,
@@ -267,37 +445,152 @@ class MyTestDataset(Dataset):
                                                     cvfold, n_way, k_shot, num_episode_per_comb, num_point))
         else:
             raise NotImplementedError('Mode (%s) is unknown!' %mode)
-
-        if os.path.exists(test_data_path):
-            self.file_names = glob.glob(os.path.join(test_data_path, '*.h5'))
+        self.test_data_path = test_data_path
+        self.pending = None
+        self.pool = None
+        self.owner_pid = os.getpid()
+
+        archive_file = test_data_path + '.h5'
+        if os.path.isdir(test_data_path) and not os.path.exists(archive_file):
+            # one h5 file per episode
+            self.archive = None
+            self.file_names = sorted(glob.glob(os.path.join(test_data_path, '*.h5')),
+                                     key=lambda f: int(os.path.basename(f)[:-3]))
             self.num_episode = len(self.file_names)
+            return
+
+        class_comb = list(combinations(self.classes, n_way))  # [(),(),(),...]
+        self.num_episode = len(class_comb) * num_episode_per_comb
+        self.archive = EpisodeArchive(archive_file)
+        if self.archive.is_complete():
+            return
+
+        print('Test dataset (%s) does not exist or is incomplete...\n Constructing...' %archive_file)
+        support_shape = (n_way, k_shot, num_point, len(pc_attribs))
+        query_shape = (n_way*n_queries, num_point, len(pc_attribs))
+        self.archive.create(self.num_episode, support_shape, query_shape, compression=compression)
+
+        archive_seed = int(hashlib.sha1(os.path.basename(test_data_path).encode()).hexdigest()[:8], 16)
+        jobs = [(episode_ind, list(class_comb[episode_ind // num_episode_per_comb]),
+                 [seed, archive_seed, episode_ind])
+                for episode_ind in range(self.num_episode) if not self.archive.constructed[episode_ind]]
+        self.num_pending = len(jobs)
+        if n_workers > 0 and self.num_pending > 0:
+            # the dataset is sent once to each worker, the tasks only carry (episode_ind, classes, seed);
+            # small chunks keep the first episodes coming early
+            self.pool = multiprocessing.Pool(n_workers, initializer=init_test_episode_worker, initargs=(dataset,))
+            self.pending = self.pool.imap(generate_test_episode, jobs,
+                                          chunksize=max(1, min(8, self.num_pending // (n_workers*4))))
+            # episodes are written to the archive by a collector thread in index order
+            self.construction_error = None
+            self.constructed_cond = threading.Condition()
+            self.collector = threading.Thread(target=self.collect_episodes, daemon=True)
+            self.collector.start()
         else:
-            print('Test dataset (%s) does not exist...\n Constructing...' %test_data_path)
-            os.mkdir(test_data_path)
-
-            class_comb = list(combinations(self.classes, n_way))  # [(),(),(),...]
-            self.num_episode = len(class_comb) * num_episode_per_comb
-
-            episode_ind = 0
-            self.file_names = []
-            for sampled_classes in class_comb:
-                sampled_classes = list(sampled_classes)
-                for i in range(num_episode_per_comb):
-                    data = dataset.__getitem__(episode_ind, sampled_classes)
-                    out_filename = os.path.join(test_data_path, '%d.h5' % episode_ind)
-
-                    write_episode(out_filename, data)
-                    self.file_names.append(out_filename)
-                    episode_ind += 1
-
-            print(out_filename)
+            for job in jobs:
+                self.episode_constructed(generate_test_episode(job, dataset=dataset))
+            self.finish_construction()
+
+    def __getstate__(self):
+        # dataloader workers only read the archive once its construction in the main process is finished
+        state = self.__dict__.copy()
+        for key in ['pending', 'pool', 'constructed_cond', 'collector']:
+            state.pop(key, None)
+        return state
+
+    def collect_episodes(self):
+        try:
+            for result in self.pending:
+                with self.constructed_cond:
+                    self.episode_constructed(result)
+                    self.constructed_cond.notify_all()
+            with self.constructed_cond:
+                self.finish_construction()
+        except Exception as e:
+            self.construction_error = e
+        with self.constructed_cond:
+            self.pending = None
+            self.constructed_cond.notify_all()
+
+    def finish_construction(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self.archive.set_complete()
+        print('Test dataset (%s) is constructed!' % self.archive.file_name)
+
+    def episode_constructed(self, result):
+        episode_ind, data = result
+        self.archive.write(episode_ind, data)
+        self.num_pending -= 1
+        num_constructed = self.num_episode - self.num_pending
+        if num_constructed % 100 == 0:
+            print('\t {0}/{1} test episodes constructed | classes: {2}'.format(
+                  num_constructed, self.num_episode, data[-1]))
+
+    def wait_episodes(self, indices):
+        if self.archive is None or self.archive.is_complete():
+            return
+        if os.getpid() != self.owner_pid:
+            # forked dataloader worker, the construction is only tracked in the main process
+            while not self.archive.is_complete():
+                time.sleep(0.1)
+            return
+        if self.pending is None:
+            return
+        with self.constructed_cond:
+            while not self.archive.constructed[indices].all():
+                if self.pending is None:
+                    raise RuntimeError('Test dataset construction failed: %s' % self.construction_error)
+                self.constructed_cond.wait()
 
     def __len__(self):
         return self.num_episode
 
     def __getitem__(self, index):
-        file_name = self.file_names[index]
-        return read_episode(file_name)
+        """
+        Read one episode, or several episodes stacked along a new first axis if `index` is a list of indices
+        (e.g. given by a BatchSampler), see batch_test_tasks_collate
+        """
+        if self.archive is None:
+            if np.isscalar(index):
+                return read_episode(self.file_names[index])
+            return tuple(np.stack(field) for field in zip(*[read_episode(self.file_names[i]) for i in index]))
+        self.wait_episodes(np.atleast_1d(index))
+        if self.pending is not None:
+            # the episodes are read from the archive under construction, not while the collector writes to it
+            with self.constructed_cond:
+                return self.archive.read(index)
+        return self.archive.read(index)
+
+
+# the MyDataset of the pool worker generating test episodes, set once by init_test_episode_worker
+_test_episode_dataset = None
+
+
+def init_test_episode_worker(dataset):
+    global _test_episode_dataset
+    _test_episode_dataset = dataset
+
+
+def generate_test_episode(job, dataset=None):
+    """
+    Generate one test episode with its own seed (a list of 32-bit integers), with the dataset of the pool worker by
+    default. The global RNG states are restored afterwards, so a serial construction does not reset them.
+    """
+    if dataset is None:
+        dataset = _test_episode_dataset
+    episode_ind, sampled_classes, seed = job
+    np_state = np.random.get_state()
+    py_state = random.getstate()
+    np.random.seed(seed)
+    random.seed(sum(s << (32*i) for i, s in enumerate(seed)))
+    try:
+        return episode_ind, dataset.__getitem__(episode_ind, sampled_classes)
+    finally:
+        np.random.set_state(np_state)
+        random.setstate(py_state)
 
 
 def batch_test_task_collate(batch):
@@ -309,19 +602,107 @@ def batch_test_task_collate(batch):
     return data, batch_sampled_classes
 
 
-def write_episode(out_filename, data):
-    support_ptclouds, support_masks, query_ptclouds, query_labels, sampled_classes = data
-    data_file = h5.File(out_filename, 'w')
-    data_file.create_dataset('support_ptclouds', data=support_ptclouds, dtype='float32')
-    data_file.create_dataset('support_masks', data=support_masks, dtype='int32')
-    data_file.create_dataset('query_ptclouds', data=query_ptclouds, dtype='float32')
-    data_file.create_dataset('query_labels', data=query_labels, dtype='int64')
-    data_file.create_dataset('sampled_classes', data=sampled_classes, dtype='int32')
-    data_file.close()
-    #print(query_ptclouds)
-    #print(query_ptclouds.shape())
+def batch_test_tasks_collate(batch):
+    """
+    Several test episodes read at once by MyTestDataset (each field stacked along a new first axis), the batched
+    counterpart of batch_test_task_collate. Use it with batch_size=None and a BatchSampler.
+    """
+    batch_support_ptclouds, batch_support_masks, batch_query_ptclouds, batch_query_labels, batch_sampled_classes = batch
+
+    data = [torch.from_numpy(batch_support_ptclouds).transpose(3,4), torch.from_numpy(batch_support_masks),
+            torch.from_numpy(batch_query_ptclouds).transpose(2,3), torch.from_numpy(batch_query_labels.astype(np.int64))]
 
-    print('\t {0} saved! | classes: {1}'.format(out_filename, sampled_classes))
+    return data, batch_sampled_classes
+
+
+class EpisodeArchive(object):
+    """
+    All episodes of one test configuration in a single h5 file: one fixed-shape dataset per field indexed by
+    episode (chunked by episode, optionally compressed) and a `constructed` flag per episode.
+    The archive is written to `<file_name>.tmp` and renamed to `file_name` once complete, so an existing
+    `file_name` is always a complete archive. Until then the writing process reads the constructed episodes back
+    through its writer, afterwards the archive is read with a read-only handle opened lazily in each process.
+    """
+    FIELDS = [('support_ptclouds', 'float32'), ('support_masks', 'int32'), ('query_ptclouds', 'float32'),
+              ('query_labels', 'int64'), ('sampled_classes', 'int32')]
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.tmp_file_name = file_name + '.tmp'
+        self.data_file = None
+        self.data_file_pid = None
+        self.writer = None
+        self.writer_pid = None
+        self.constructed = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['data_file'] = None
+        state['writer'] = None
+        return state
+
+    def open(self):
+        if self.writer is not None and self.writer_pid == os.getpid():
+            # episodes written so far are read back through the writer until the archive is complete
+            return self.writer
+        if self.data_file is None or self.data_file_pid != os.getpid():
+            self.data_file = h5.File(self.file_name, 'r')
+            self.data_file_pid = os.getpid()
+        return self.data_file
+
+    def is_complete(self):
+        return os.path.exists(self.file_name)
+
+    def create(self, num_episode, support_shape, query_shape, compression=None):
+        """Create the datasets in the temporary file (or re-open it to resume an interrupted construction)"""
+        if os.path.exists(self.tmp_file_name):
+            try:
+                self.writer = h5.File(self.tmp_file_name, 'a')
+                self.writer_pid = os.getpid()
+                self.constructed = self.writer['constructed'][:]
+                return
+            except (OSError, KeyError):
+                # e.g. the process was killed in the middle of a write
+                print('Warning: cannot resume from %s, rebuilding it from scratch' % self.tmp_file_name)
+                if self.writer is not None:
+                    self.writer.close()
+                    self.writer = None
+                os.remove(self.tmp_file_name)
+        n_way = support_shape[0]
+        shapes = [support_shape, support_shape[:-1], query_shape, query_shape[:-1], (n_way,)]
+        self.writer = h5.File(self.tmp_file_name, 'w')
+        self.writer_pid = os.getpid()
+        for (field, dtype), shape in zip(self.FIELDS, shapes):
+            self.writer.create_dataset(field, shape=(num_episode,)+shape, dtype=dtype, chunks=(1,)+shape,
+                                       compression=compression)
+        self.writer.create_dataset('constructed', shape=(num_episode,), dtype='bool')
+        self.constructed = np.zeros(num_episode, dtype=bool)
+
+    def write(self, index, data):
+        for (field, _), value in zip(self.FIELDS, data):
+            self.writer[field][index] = value
+        self.writer['constructed'][index] = True
+        # an interrupted construction can be resumed up to the last flushed episode
+        self.writer.flush()
+        self.constructed[index] = True
+
+    def set_complete(self):
+        self.writer.close()
+        self.writer = None
+        os.rename(self.tmp_file_name, self.file_name)
+
+    def read(self, indices):
+        """Read one episode (integer index) or several episodes stacked along a new first axis (list of indices)"""
+        data_file = self.open()
+        if np.isscalar(indices):
+            return tuple(data_file[field][indices] for field, _ in self.FIELDS)
+        indices = np.asarray(indices, dtype=np.int64)
+        if len(indices) > 0 and np.array_equal(indices, np.arange(indices[0], indices[0]+len(indices))):
+            selection = slice(int(indices[0]), int(indices[0])+len(indices))
+            return tuple(data_file[field][selection] for field, _ in self.FIELDS)
+        # h5py fancy indexing needs increasing unique indices
+        unique_indices, inverse = np.unique(indices, return_inverse=True)
+        return tuple(data_file[field][unique_indices][inverse] for field, _ in self.FIELDS)
 
 
 def read_episode(file_name):
@@ -339,9 +720,12 @@ def read_episode(file_name):
 ################################################  Pre-train Dataset ################################################
 class MyPretrainDataset(Dataset):
     def __init__(self, data_path, classes, class2scans, mode='train', num_point=4096, pc_attribs='xyz',
-                       pc_augm=False, pc_augm_config=None):
+                       pc_augm=False, pc_augm_config=None, block_store=None):
         super(MyPretrainDataset).__init__()
         self.data_path = data_path
+        if block_store is None:
+            block_store = open_block_store(data_path)
+        self.block_store = block_store
         self.classes = classes
         self.num_point = num_point
         self.pc_attribs = pc_attribs
@@ -372,7 +756,7 @@ class MyPretrainDataset(Dataset):
     def __getitem__(self, index):
         block_name = self.block_names[index]
 
-        ptcloud, label = sample_pointcloud(self.data_path, self.num_point, self.pc_attribs, self.pc_augm,
+        ptcloud, label = sample_pointcloud(self.block_store, self.num_point, self.pc_attribs, self.pc_augm,
                                            self.pc_augm_config, block_name, self.classes, random_sample=True)
 
         return torch.from_numpy(ptcloud.transpose().astype(np.float32)), torch.from_numpy(label.astype(np.int64))
@@ -2,14 +2,17 @@
 
 """
 import os
-import glob
-import numpy as np
-import pickle
+
+from dataloaders.block_store import open_block_store
+from dataloaders.class2scans import build_class2scans
 
 
 class ScanNetDataset(object):
-    def __init__(self, cvfold, data_path):
+    def __init__(self, cvfold, data_path, block_store=None):
         self.data_path = data_path
+        if block_store is None:
+            block_store = open_block_store(data_path)
+        self.block_store = block_store
         self.classes = 21
         # self.class2type = {0:'unannotated', 1:'wall', 2:'floor', 3:'chair', 4:'table', 5:'desk', 6:'bed', 7:'bookshelf',
         #                    8:'sofa', 9:'sink', 10:'bathtub', 11:'toilet', 12:'curtain', 13:'counter', 14:'door',
@@ -17,7 +20,7 @@ class ScanNetDataset(object):
         class_names = open(os.path.join(os.path.dirname(data_path), 'meta', 'scannet_classnames.txt')).readlines()
         self.class2type = {i: name.strip() for i, name in enumerate(class_names)}
         self.type2class = {self.class2type[t]: t for t in self.class2type}
-        self.types = self.type2class.keys()
+        self.types = list(self.type2class.keys())
 
         self.fold_0 = ['bathtub', 'bed', 'bookshelf', 'cabinet', 'chair','counter', 'curtain', 'desk', 'door', 'floor']
         self.fold_1 = ['otherfurniture', 'picture', 'refridgerator', 'shower curtain', 'sink', 'sofa', 'table', 'toilet', 'wall', 'window']
@@ -34,37 +37,22 @@ class ScanNetDataset(object):
 
         self.class2scans = self.get_class2scans()
 
-    def get_class2scans(self):
-        class2scans_file = os.path.join(self.data_path, 'class2scans.pkl')
-        if os.path.exists(class2scans_file):
-            #load class2scans (dictionary)
-            with open(class2scans_file, 'rb') as f:
-                class2scans = pickle.load(f)
-        else:
-            min_ratio = .05  # to filter out scans with only rare labelled points
-            min_pts = 100  # to filter out scans with only rare labelled points
-            class2scans = {k:[] for k in range(self.classes)}
-
-            for file in glob.glob(os.path.join(self.data_path, 'data', '*.npy')):
-                scan_name = os.path.basename(file)[:-4]
-                data = np.load(file)
-                labels = data[:,6].astype(np.int)
-                classes = np.unique(labels)
-                print('{0} | shape: {1} | classes: {2}'.format(scan_name, data.shape, list(classes)))
-                for class_id in classes:
-                    #if the number of points for the target class is too few, do not add this sample into the dictionary
-                    num_points = np.count_nonzero(labels == class_id)
-                    threshold = max(int(data.shape[0]*min_ratio), min_pts)
-                    if num_points > threshold:
-                        class2scans[class_id].append(scan_name)
+    def get_class2scans(self, min_ratio=.05, min_pts=100):
+        """
+        Map each class to the blocks that contain enough points of it, loaded from class2scans.pkl while it is up
+        to date, otherwise derived from the cached per-block class histograms so that only new/modified blocks are
+        scanned
+        Args:
+            min_ratio: to filter out scans with only rare labelled points
+            min_pts: to filter out scans with only rare labelled points
+        """
+        class2scans = build_class2scans(self.block_store, self.classes, min_ratio=min_ratio, min_pts=min_pts)
 
-            print('==== class to scans mapping is done ====')
-            for class_id in range(self.classes):
-                print('\t class_id: {0} | min_ratio: {1} | min_pts: {2} | class_name: {3} | num of scans: {4}'.format(
-                          class_id,  min_ratio, min_pts, self.class2type[class_id], len(class2scans[class_id])))
+        print('==== class to scans mapping is done ====')
+        for class_id in range(self.classes):
+            print('\t class_id: {0} | min_ratio: {1} | min_pts: {2} | class_name: {3} | num of scans: {4}'.format(
+                      class_id,  min_ratio, min_pts, self.class2type[class_id], len(class2scans[class_id])))
 
-            with open(class2scans_file, 'wb') as f:
-                pickle.dump(class2scans, f, pickle.HIGHEST_PROTOCOL)
         return class2scans
 
 
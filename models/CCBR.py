@@ -44,8 +44,11 @@ class ProtoNet(nn.Module):
         self.in_channels = args.pc_in_dim
         self.n_points = args.pc_npts
         self.use_attention = args.use_attention
+        self.joint_encoding = args.joint_encoding
 
-        self.encoder = DGCNN(args.edgeconv_widths, args.dgcnn_mlp_widths, args.pc_in_dim, k=args.dgcnn_k)
+        self.encoder = DGCNN(args.edgeconv_widths, args.dgcnn_mlp_widths, args.pc_in_dim, k=args.dgcnn_k,
+                             knn_chunk_size=args.dgcnn_knn_chunk, edgeconv=args.dgcnn_edgeconv,
+                             static_graph=args.dgcnn_static_graph)
         self.base_learner = BaseLearner(args.dgcnn_mlp_widths[-1], args.base_widths)
 
         if self.use_attention:
@@ -70,11 +73,48 @@ class ProtoNet(nn.Module):
         """
 
         support_x = support_x.view(self.n_way*self.k_shot, self.in_channels, self.n_points)
-        support_feat = self.getFeatures(support_x)
-        sf = support_feat
+        support_feat, query_feat = self.getEpisodeFeatures(support_x, query_x)
+        return self.predict(support_feat, support_y, query_feat, query_y)
 
+    def forward_batch(self, support_x, support_y, query_x, query_y):
+        """
+        Forward several episodes at once, the support and query clouds of all episodes are encoded in one batch.
+        Only meant for evaluation, in train mode BatchNorm statistics would depend on the batch composition.
+        Args:
+            support_x: support point clouds with shape (n_episodes, n_way, k_shot, in_channels, num_points)
+            support_y: support masks (foreground) with shape (n_episodes, n_way, k_shot, num_points)
+            query_x: query point clouds with shape (n_episodes, n_queries, in_channels, num_points)
+            query_y: query labels with shape (n_episodes, n_queries, num_points)
+        Return:
+            query_pred: query point clouds predicted similarity, shape: (n_episodes, n_queries, n_way+1, num_points)
+            loss: loss of each episode, shape: (n_episodes,)
+        """
+        n_episodes, n_queries = query_x.shape[:2]
+        n_support = n_episodes*self.n_way*self.k_shot
+        support_x = support_x.reshape(n_support, self.in_channels, self.n_points)
+        query_x = query_x.reshape(n_episodes*n_queries, self.in_channels, self.n_points)
+        feat = self.getFeatures(torch.cat((support_x, query_x), dim=0))
+        support_feat = feat[:n_support].view(n_episodes, self.n_way*self.k_shot, -1, self.n_points)
+        query_feat = feat[n_support:].view(n_episodes, n_queries, -1, self.n_points)
+
+        query_pred, loss = zip(*[self.predict(support_feat[i], support_y[i], query_feat[i], query_y[i])
+                                 for i in range(n_episodes)])
+        return torch.stack(query_pred), torch.stack(loss)
+
+    def predict(self, support_feat, support_y, query_feat, query_y):
+        """
+        Compute the prototypes of one episode from its encoded support set and classify the query points
+        Args:
+            support_feat: support features with shape (n_way*k_shot, feat_dim, num_points)
+            support_y: support masks (foreground) with shape (n_way, k_shot, num_points)
+            query_feat: query features with shape (n_queries, feat_dim, num_points)
+            query_y: query labels with shape (n_queries, num_points), None if unknown (the loss is then None)
+        Return:
+            query_pred: query point clouds predicted similarity, shape: (n_queries, n_way+1, num_points)
+        Note: the support features are adapted to the query in place
+        """
+        sf = support_feat
         support_feat = support_feat.view(self.n_way, self.k_shot, -1, self.n_points)
-        query_feat = self.getFeatures(query_x)
         qf = query_feat
 
         s1 = self.maxp1(sf.permute(0, 2, 1).contiguous())
@@ -107,7 +147,7 @@ class ProtoNet(nn.Module):
         similarity = [self.calculateSimilarity(query_feat, prototype, self.dist_method) for prototype in prototypes] 
 
         query_pred = torch.stack(similarity, dim=1)
-        loss = self.computeCrossEntropyLoss(query_pred, query_y)
+        loss = None if query_y is None else self.computeCrossEntropyLoss(query_pred, query_y)
         return query_pred, loss
 
 
@@ -129,6 +169,19 @@ class ProtoNet(nn.Module):
             map_feat = self.linear_mapper(feat_level2)
             return torch.cat((feat_level1, map_feat, feat_level3), dim=1)
 
+    def getEpisodeFeatures(self, support_x, query_x):
+        """
+        Encode the support and query clouds of one episode, in a single encoder batch in eval mode (where it gives
+        the same features) or if joint_encoding is set (BatchNorm statistics are then shared in training)
+        :param support_x: support data with shape (n_support, C_in, L)
+        :param query_x: query data with shape (n_queries, C_in, L)
+        :return: support and query features with shape (n_support, C_out, L) and (n_queries, C_out, L)
+        """
+        if self.joint_encoding or not self.training:
+            feat = self.getFeatures(torch.cat((support_x, query_x), dim=0))
+            return feat[:support_x.shape[0]], feat[support_x.shape[0]:]
+        return self.getFeatures(support_x), self.getFeatures(query_x)
+
     def getMaskedFeatures(self, feat, mask):
         """
         Extract foreground and background features via masked average pooling
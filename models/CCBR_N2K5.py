@@ -42,7 +42,9 @@ class ProtoNet(nn.Module):
         self.n_points = args.pc_npts
         self.use_attention = args.use_attention
 
-        self.encoder = DGCNN(args.edgeconv_widths, args.dgcnn_mlp_widths, args.pc_in_dim, k=args.dgcnn_k)
+        self.encoder = DGCNN(args.edgeconv_widths, args.dgcnn_mlp_widths, args.pc_in_dim, k=args.dgcnn_k,
+                             knn_chunk_size=args.dgcnn_knn_chunk, edgeconv=args.dgcnn_edgeconv,
+                             static_graph=args.dgcnn_static_graph)
         self.base_learner = BaseLearner(args.dgcnn_mlp_widths[-1], args.base_widths)
 
         if self.use_attention:
@@ -8,28 +8,60 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from utils.amp_util import fp32
 
-def knn(x, k):
-    inner = -2 * torch.matmul(x.transpose(2, 1), x) #(B,N,N)
-    xx = torch.sum(x ** 2, dim=1, keepdim=True) #(B,1,N)
-    pairwise_distance = -xx - inner - xx.transpose(2, 1) #(B,N,N)
 
-    idx = pairwise_distance.topk(k=k, dim=-1)[1]  # (B,N,k)
+def knn(x, k, chunk_size=0):
+    """
+    Args:
+        x: point features (B, C, N)
+        k: int
+        chunk_size: if > 0, the distances are computed for chunk_size query points at a time,
+                    bounding the peak memory to (B, chunk_size, N) instead of (B, N, N)
+    Returns:
+        idx: knn index (B, N, k)
+    """
+    if chunk_size > 0:
+        return knn_chunked(x, k, chunk_size)
+    # distances in fp32 under mixed precision, half precision would reorder the close neighbors
+    with fp32(x):
+        x = x.float()
+        inner = -2 * torch.matmul(x.transpose(2, 1), x) #(B,N,N)
+        xx = torch.sum(x ** 2, dim=1, keepdim=True) #(B,1,N)
+        pairwise_distance = -xx - inner - xx.transpose(2, 1) #(B,N,N)
+
+        idx = pairwise_distance.topk(k=k, dim=-1)[1]  # (B,N,k)
     return idx
 
 
-def get_edge_feature(x, K=20, idx=None):
+def knn_chunked(x, k, chunk_size):
+    """Same as knn, processing the query points by blocks of chunk_size"""
+    with torch.no_grad(), fp32(x):
+        x = x.float()
+        xx = torch.sum(x ** 2, dim=1, keepdim=True) #(B,1,N)
+        x_t = x.transpose(2, 1) #(B,N,C)
+        idx = []
+        for start in range(0, x.shape[2], chunk_size):
+            end = min(start + chunk_size, x.shape[2])
+            inner = -2 * torch.matmul(x_t[:, start:end], x) #(B,chunk,N)
+            pairwise_distance = -xx - inner - xx[:, :, start:end].transpose(2, 1) #(B,chunk,N)
+            idx.append(pairwise_distance.topk(k=k, dim=-1)[1]) #(B,chunk,k)
+    return torch.cat(idx, dim=1)
+
+
+def get_edge_feature(x, K=20, idx=None, knn_chunk_size=0):
     """Construct edge feature for each point
       Args:
         x: point clouds (B, C, N)
         K: int
         idx: knn index, if not None, the shape is (B, N, K)
+        knn_chunk_size: query points per block of the knn search, 0 for a single (B, N, N) block
       Returns:
         edge feat: (B, 2C, N, K)
     """
     B, C, N = x.size()
     if idx is None:
-        idx = knn(x, k=K)  # (batch_size, num_points, k)
+        idx = knn(x, k=K, chunk_size=knn_chunk_size)  # (batch_size, num_points, k)
     central_feat = x.unsqueeze(-1).expand(-1,-1,-1,K)
     idx = idx.unsqueeze(1).expand(-1, C, -1, -1).contiguous().view(B,C,N*K)
     knn_feat = torch.gather(x, dim=2, index=idx).contiguous().view(B,C,N,K)
@@ -37,6 +69,47 @@ def get_edge_feature(x, K=20, idx=None):
     return edge_feat
 
 
+def fused_edge_conv(x, idx, edge_conv, chunk_size=0):
+    """EdgeConv without building the (B, 2C, N, K) edge features.
+       The first 1x1 conv is linear, W [x_j - x_i, x_i] = W1 x_j + (W2 - W1) x_i, so it is applied on the (B, C, N)
+       point features before gathering the neighbors. Gives the same output as
+       edge_conv(get_edge_feature(x, idx=idx)).max(dim=-1)[0]
+      Args:
+        x: point clouds (B, C, N)
+        idx: knn index (B, N, K)
+        edge_conv: conv2d block whose first layer takes the 2C edge features
+        chunk_size: in eval mode, query points per block of the gather/conv/max, bounding the activations to
+                    (B, C', chunk_size, K); ignored in train mode where batch norm needs all the points at once
+      Returns:
+        edge conv feat: (B, C', N)
+    """
+    B, C, N = x.size()
+    K = idx.shape[2]
+    layers = list(edge_conv.layer)
+    conv = layers[0]
+    weight = conv.weight.view(conv.out_channels, 2*C)
+    w_neighbor, w_central = weight[:, :C], weight[:, C:]
+    neighbor_feat = torch.matmul(w_neighbor, x) #(B,C',N)
+    central_feat = torch.matmul(w_central - w_neighbor, x) #(B,C',N)
+    if conv.bias is not None:
+        central_feat = central_feat + conv.bias.view(1, -1, 1)
+    C_out = neighbor_feat.shape[1]
+
+    if chunk_size <= 0 or edge_conv.training:
+        chunk_size = N
+    out = []
+    for start in range(0, N, chunk_size):
+        chunk_idx = idx[:, start:start+chunk_size] #(B,n,K)
+        n = chunk_idx.shape[1]
+        chunk_idx = chunk_idx.reshape(B, 1, n*K).expand(-1, C_out, -1)
+        edge_feat = torch.gather(neighbor_feat, dim=2, index=chunk_idx).view(B, C_out, n, K)
+        edge_feat = edge_feat + central_feat[:, :, start:start+n].unsqueeze(-1) #(B,C',n,K)
+        for layer in layers[1:]:
+            edge_feat = layer(edge_feat)
+        out.append(edge_feat.max(dim=-1, keepdim=False)[0])
+    return torch.cat(out, dim=2)
+
+
 class conv2d(nn.Module):
     def __init__(self, in_feat, layer_dims, batch_norm=True, relu=True, bias=False):
         super().__init__()
@@ -84,11 +157,23 @@ class DGCNN(nn.Module):
       nfeat: number of input features
       k: number of neighbors
       conv_aggr: neighbor information aggregation method, Option:['add', 'mean', 'max', None]
+      knn_chunk_size: query points per block of the knn search (and of the fused edgeconv in eval mode),
+                      0 processes all the points at once
+      edgeconv: 'concat' applies the convs on the concatenated edge features, 'fused' decomposes the first conv
+                to avoid building them (see fused_edge_conv), both share the same parameters
+      static_graph: if True, the knn graph is computed once on the xyz coordinates (first 3 input channels) and
+                    shared by all the Edgeconv layers, instead of being recomputed on the features of each layer
     """
-    def __init__(self, edgeconv_widths, mlp_widths, nfeat, k=20, return_edgeconvs=False):
+    def __init__(self, edgeconv_widths, mlp_widths, nfeat, k=20, return_edgeconvs=False, knn_chunk_size=0,
+                 edgeconv='concat', static_graph=False):
         super(DGCNN, self).__init__()
+        if edgeconv not in ['concat', 'fused']:
+            raise ValueError('Wrong Edgeconv implementation (%s)! Option:concat/fused' % edgeconv)
         self.n_edgeconv = len(edgeconv_widths)
         self.k = k
+        self.knn_chunk_size = knn_chunk_size
+        self.edgeconv = edgeconv
+        self.static_graph = static_graph
         self.return_edgeconvs = return_edgeconvs
 
         self.edge_convs = nn.ModuleList()
@@ -107,10 +192,17 @@ class DGCNN(nn.Module):
 
     def forward(self, x):
         edgeconv_outputs = []
+        idx = None
+        if self.static_graph:
+            idx = knn(x[:, :3], k=self.k, chunk_size=self.knn_chunk_size)
         for i in range(self.n_edgeconv):
-            x = get_edge_feature(x, K=self.k)
-            x = self.edge_convs[i](x)
-            x = x.max(dim=-1, keepdim=False)[0]
+            if self.edgeconv == 'fused':
+                layer_idx = idx if idx is not None else knn(x, k=self.k, chunk_size=self.knn_chunk_size)
+                x = fused_edge_conv(x, layer_idx, self.edge_convs[i], chunk_size=self.knn_chunk_size)
+            else:
+                x = get_edge_feature(x, K=self.k, idx=idx, knn_chunk_size=self.knn_chunk_size)
+                x = self.edge_convs[i](x)
+                x = x.max(dim=-1, keepdim=False)[0]
             edgeconv_outputs.append(x)
 
         out = torch.cat(edgeconv_outputs, dim=1)
@@ -0,0 +1,132 @@
+""" k-Nearest Neighbor Search Backends for Graph Construction
+
+Every backend searches the k nearest neighbors of each row of x among the rows of x itself (L2 metric) and returns
+the squared distances and indices as tensors on the device of x:
+  - torch: exact blockwise search on the device of x, no host round-trip
+  - faiss_flat: exact search with faiss.IndexFlatL2 on host
+  - faiss_ivf: approximate search with an inverted file index (faiss.IndexIVFFlat), trained on x
+  - faiss_hnsw: approximate search with a HNSW graph (faiss.IndexHNSWFlat)
+faiss is only imported when a faiss index is built, so the torch backend works without it.
+"""
+import math
+import numpy as np
+
+import torch
+
+KNN_BACKENDS = ['faiss_flat', 'torch', 'faiss_ivf', 'faiss_hnsw']
+
+
+def build_knn_backend(args):
+    """Create the kNN backend selected by --knn_backend"""
+    if args.knn_backend == 'torch':
+        return TorchKNN(block_size=args.knn_block_size)
+    elif args.knn_backend == 'faiss_flat':
+        return FaissFlatKNN()
+    elif args.knn_backend == 'faiss_ivf':
+        return FaissIVFKNN(nlist=args.knn_nlist, nprobe=args.knn_nprobe)
+    elif args.knn_backend == 'faiss_hnsw':
+        return FaissHNSWKNN(M=args.knn_hnsw_m, ef_search=args.knn_ef_search)
+    else:
+        raise NotImplementedError('Error! kNN backend (%s) is unknown!' % args.knn_backend)
+
+
+class TorchKNN(object):
+    """
+    Exact kNN with matmul + topk on the device of the input, processed by blocks of query rows so that the
+    distance matrix never exceeds (block_size, num_points).
+    """
+    def __init__(self, block_size=4096):
+        self.block_size = block_size
+
+    def search(self, x, k):
+        """
+        Args:
+            x: points, shape: (num_points, dim)
+            k: number of neighbors, the point itself is usually the first one
+        Return:
+            sq_dist: squared L2 distances, shape: (num_points, k)
+            idx: neighbor indices (int64), shape: (num_points, k)
+        """
+        x = x.detach()
+        sq_norm = (x**2).sum(1)
+        sq_dist = []
+        idx = []
+        for start in range(0, x.shape[0], self.block_size):
+            block = x[start:start+self.block_size]
+            dist = sq_norm[start:start+self.block_size, None] + sq_norm[None, :] - 2 * block @ x.t()
+            block_dist, block_idx = dist.topk(k, dim=1, largest=False)
+            sq_dist.append(block_dist.clamp(min=0))
+            idx.append(block_idx)
+        return torch.cat(sq_dist, dim=0), torch.cat(idx, dim=0)
+
+
+class FaissKNN(object):
+    """Base class of the faiss backends, subclasses implement build_index()"""
+    def build_index(self, X, k):
+        raise NotImplementedError
+
+    def search(self, x, k):
+        """Same as TorchKNN.search, the search runs on host with the index built from x"""
+        X = np.ascontiguousarray(x.detach().cpu().numpy(), dtype=np.float32)
+        index = self.build_index(X, k)
+        D, I = index.search(X, k)
+        missing = I < 0
+        if missing.any():
+            # approximate indices may return fewer than k results, point them to the query itself with an infinite
+            # distance so that they get a zero weight in the graph
+            I = np.where(missing, np.arange(X.shape[0])[:, None], I)
+            D = np.where(missing, np.inf, D)
+        return torch.from_numpy(D).to(x.device), torch.from_numpy(I).to(x.device)
+
+
+class FaissFlatKNN(FaissKNN):
+    def build_index(self, X, k):
+        import faiss
+        index = faiss.IndexFlatL2(X.shape[1])
+        index.add(X)
+        return index
+
+
+class FaissIVFKNN(FaissKNN):
+    """
+    Parameters:
+      nlist: number of inverted lists, 0 picks 4*sqrt(num_points) (capped so that each list gets enough training points)
+      nprobe: number of lists visited per query
+    """
+    def __init__(self, nlist=0, nprobe=8):
+        self.nlist = nlist
+        self.nprobe = nprobe
+
+    def build_index(self, X, k):
+        import faiss
+        num_points, dim = X.shape
+        nlist = self.nlist
+        if nlist <= 0:
+            nlist = min(int(4 * math.sqrt(num_points)), num_points // 39)
+        nlist = max(1, min(nlist, num_points))
+        quantizer = faiss.IndexFlatL2(dim)
+        index = faiss.IndexIVFFlat(quantizer, dim, nlist)
+        index.train(X)
+        index.add(X)
+        index.nprobe = min(self.nprobe, nlist)
+        # keep the quantizer alive as long as the index
+        index.quantizer_ref = quantizer
+        return index
+
+
+class FaissHNSWKNN(FaissKNN):
+    """
+    Parameters:
+      M: number of neighbors of each node in the HNSW graph
+      ef_search: size of the candidate list during search, must be >= k for a good recall
+    """
+    def __init__(self, M=32, ef_search=64):
+        self.M = M
+        self.ef_search = ef_search
+
+    def build_index(self, X, k):
+        import faiss
+        index = faiss.IndexHNSWFlat(X.shape[1], self.M)
+        index.hnsw.efSearch = max(self.ef_search, k)
+        index.add(X)
+        return index
@@ -1,14 +1,19 @@
 
 import numpy as np
-import faiss
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch_cluster
 from torch_cluster import fps
 
 from models.dgcnn import DGCNN
 from models.attention import SelfAttention
+from models.knn_search import build_knn_backend
+from utils.amp_util import fp32
+
+# a tensor of per-batch FPS ratios is only accepted from torch_cluster 1.6 on, older versions take one float ratio
+FPS_BATCHED_RATIO = tuple(int(v) for v in torch_cluster.__version__.split('.')[:2]) >= (1, 6)
 
 
 class BaseLearner(nn.Module):
@@ -45,13 +50,21 @@ class MultiPrototypeTransductiveInference(nn.Module):
         self.in_channels = args.pc_in_dim
         self.n_points = args.pc_npts
         self.use_attention = args.use_attention
+        self.joint_encoding = args.joint_encoding
         self.n_subprototypes = args.n_subprototypes
         self.k_connect = args.k_connect
         self.sigma = args.sigma
+        self.lp_solver = args.lp_solver
+        self.lp_iters = args.lp_iters
+        self.lp_tol = args.lp_tol
+        self.knn = build_knn_backend(args)
+        self.n_kmeans_iters = args.n_kmeans_iters
 
         self.n_classes = self.n_way+1
 
-        self.encoder = DGCNN(args.edgeconv_widths, args.dgcnn_mlp_widths, args.pc_in_dim, k=args.dgcnn_k)
+        self.encoder = DGCNN(args.edgeconv_widths, args.dgcnn_mlp_widths, args.pc_in_dim, k=args.dgcnn_k,
+                             knn_chunk_size=args.dgcnn_knn_chunk, edgeconv=args.dgcnn_edgeconv,
+                             static_graph=args.dgcnn_static_graph)
         self.base_learner = BaseLearner(args.dgcnn_mlp_widths[-1], args.base_widths)
 
         if self.use_attention:
@@ -72,9 +85,23 @@ class MultiPrototypeTransductiveInference(nn.Module):
             query_pred: query point clouds predicted similarity, shape: (n_queries, n_way+1, num_points)
         """
         support_x = support_x.view(self.n_way*self.k_shot, self.in_channels, self.n_points)
-        support_feat = self.getFeatures(support_x)
-        
-        query_feat = self.getFeatures(query_x) #(n_queries, feat_dim, num_points)
+        support_feat, query_feat = self.getEpisodeFeatures(support_x, query_x) #(n_queries, feat_dim, num_points)
+
+        # prototypes, affinities and label propagation (matrix inverse/solver) stay in fp32 under mixed precision
+        with fp32(query_feat):
+            return self.predict(support_feat.float(), support_y, query_feat.float(), query_y)
+
+    def predict(self, support_feat, support_y, query_feat, query_y):
+        """
+        Extract the prototypes of one episode from its encoded support set and propagate their labels to the query points
+        Args:
+            support_feat: support features with shape (n_way*k_shot, feat_dim, num_points)
+            support_y: support masks (foreground) with shape (n_way, k_shot, num_points)
+            query_feat: query features with shape (n_queries, feat_dim, num_points)
+            query_y: query labels with shape (n_queries, num_points), None if unknown (the loss is then None)
+        Return:
+            query_pred: query point clouds predicted similarity, shape: (n_queries, n_way+1, num_points)
+        """
         query_feat = query_feat.transpose(1,2).contiguous().view(-1, self.feat_dim) #(n_queries*num_points, feat_dim)
 
         # sf = support_feat
@@ -93,41 +120,31 @@ class MultiPrototypeTransductiveInference(nn.Module):
         fg_mask = support_y
         bg_mask = torch.logical_not(support_y)
 
-        fg_prototypes, fg_labels = self.getForegroundPrototypes(support_feat, fg_mask, k=self.n_subprototypes)
-        bg_prototype, bg_labels = self.getBackgroundPrototypes(support_feat, bg_mask, k=self.n_subprototypes)
-
-        # prototype learning
-        if bg_prototype is not None and bg_labels is not None:
-            prototypes = torch.cat((bg_prototype, fg_prototypes), dim=0) #(*, feat_dim)
-            prototype_labels = torch.cat((bg_labels, fg_labels), dim=0) #(*,n_classes)
-
-            #print(prototypes.size())
-            #print(prototypes.type())
-            #print(prototype_labels.size())
-            #print(prototype_labels)
-        else:
-            prototypes = fg_prototypes
-            prototype_labels = fg_labels
+        # prototype learning, background prototypes first then the foreground ones of each way
+        prototypes, prototype_labels = self.getPrototypes(support_feat, fg_mask, bg_mask, k=self.n_subprototypes)
         self.num_prototypes = prototypes.shape[0]
 
         # construct label matrix Y, with Y_ij = 1 if x_i is from the support set and labeled as y_i = j, otherwise Y_ij = 0.
         self.num_nodes = self.num_prototypes + query_feat.shape[0] # number of node of partial observed graph
-        print(self.num_nodes)
-        Y = torch.zeros(self.num_nodes, self.n_classes).cuda()
-        print(Y[:self.num_prototypes])
-        #print(prototype_labels)
+        Y = torch.zeros(self.num_nodes, self.n_classes, device=query_feat.device)
         Y[:self.num_prototypes] = prototype_labels
 
         # construct feat matrix F
         node_feat = torch.cat((prototypes, query_feat), dim=0) #(num_nodes, feat_dim)
 
         # label propagation
-        A = self.calculateLocalConstrainedAffinity(node_feat, k=self.k_connect)
-        Z = self.label_propagate(A, Y) #(num_nodes, n_way+1)
+        if self.lp_solver == 'dense':
+            A = self.calculateLocalConstrainedAffinity(node_feat, k=self.k_connect)
+            Z = self.label_propagate(A, Y) #(num_nodes, n_way+1)
+        elif self.lp_solver == 'cg':
+            edges = self.calculateSparseAffinity(node_feat, k=self.k_connect)
+            Z = self.label_propagate_sparse(edges, Y)
+        else:
+            raise NotImplementedError('Error! Label propagation solver (%s) is unknown!' % self.lp_solver)
 
         query_pred = Z[self.num_prototypes:, :] #(n_queries*num_points, n_way+1)
-        query_pred = query_pred.view(-1, query_y.shape[1], self.n_classes).transpose(1,2) #(n_queries, n_way+1, num_points)
-        loss = self.computeCrossEntropyLoss(query_pred, query_y)
+        query_pred = query_pred.view(-1, self.n_points, self.n_classes).transpose(1,2) #(n_queries, n_way+1, num_points)
+        loss = None if query_y is None else self.computeCrossEntropyLoss(query_pred, query_y)
         return query_pred, loss
 
     def getFeatures(self, x):
@@ -148,96 +165,133 @@ class MultiPrototypeTransductiveInference(nn.Module):
             map_feat = self.linear_mapper(feat_level2)
             return torch.cat((feat_level1, map_feat, feat_level3), dim=1)
 
-    def getMutiplePrototypes(self, feat, k):
+    def getEpisodeFeatures(self, support_x, query_x):
+        """
+        Encode the support and query clouds of one episode, in a single encoder batch in eval mode (where it gives
+        the same features) or if joint_encoding is set (BatchNorm statistics are then shared in training)
+        :param support_x: support data with shape (n_support, C_in, L)
+        :param query_x: query data with shape (n_queries, C_in, L)
+        :return: support and query features with shape (n_support, C_out, L) and (n_queries, C_out, L)
+        """
+        if self.joint_encoding or not self.training:
+            feat = self.getFeatures(torch.cat((support_x, query_x), dim=0))
+            return feat[:support_x.shape[0]], feat[support_x.shape[0]:]
+        return self.getFeatures(support_x), self.getFeatures(query_x)
+
+    def getClusterMeans(self, feat, assignments, centers):
         """
-        Extract multiple prototypes by points separation and assembly
+        Average the points of each cluster in one pass
 
         Args:
-            feat: input point features, shape:(n_points, feat_dim)
+            feat: input point features, shape: (n_points, feat_dim)
+            assignments: cluster index of each point, shape: (n_points,)
+            centers: current cluster centers, kept for empty clusters, shape: (n_clusters, feat_dim)
         Return:
-            prototypes: output prototypes, shape: (n_prototypes, feat_dim)
+            means: cluster means, shape: (n_clusters, feat_dim)
         """
-        # sample k seeds as initial centers with Farthest Point Sampling (FPS)
-        n = feat.shape[0]
-        assert n > 0
-        ratio = k / n
-        if ratio < 1:
-            fps_index = fps(feat, None, ratio=ratio, random_start=False).unique()
-            num_prototypes = len(fps_index)
-            farthest_seeds = feat[fps_index]
-
-            # compute the point-to-seed distance
-            distances = F.pairwise_distance(feat[..., None], farthest_seeds.transpose(0, 1)[None, ...],
-                                            p=2)  # (n_points, n_prototypes)
-
-            # hard assignment for each point
-            assignments = torch.argmin(distances, dim=1)  # (n_points,)
-
-            # aggregating each cluster to form prototype
-            prototypes = torch.zeros((num_prototypes, self.feat_dim)).cuda()
-            for i in range(num_prototypes):
-                selected = torch.nonzero(assignments == i).squeeze(1)
-                selected = feat[selected, :]
-                prototypes[i] = selected.mean(0)
-            return prototypes
-        else:
-            return feat
+        n_clusters = centers.shape[0]
+        sums = torch.zeros_like(centers).index_add(0, assignments, feat)
+        counts = torch.bincount(assignments, minlength=n_clusters).unsqueeze(1)
+        return torch.where(counts > 0, sums / counts.clamp(min=1), centers)
 
-    def getForegroundPrototypes(self, feats, masks, k=100):
+    def getPrototypes(self, feats, fg_masks, bg_masks, k=100):
         """
-        Extract foreground prototypes for each class via clustering point features within that class
+        Extract the background prototypes and the foreground prototypes of every way at once: the point features
+        are grouped (background, way 1, ..., way n), sampled with one batched FPS call (one call per group with
+        torch_cluster < 1.6) and clustered within each group, so each group gets up to k prototypes as if it was
+        clustered on its own.
 
         Args:
             feats: input support features, shape: (n_way, k_shot, feat_dim, num_points)
-            masks: foreground binary masks, shape: (n_way, k_shot, num_points)
+            fg_masks: foreground binary masks, shape: (n_way, k_shot, num_points)
+            bg_masks: background binary masks, shape: (n_way, k_shot, num_points)
         Return:
-            prototypes: foreground prototypes, shape: (n_way*k, feat_dim)
-            labels: foreground prototype labels (one-hot), shape: (n_way*k, n_way+1)
+            prototypes: prototypes of all groups, shape: (n_prototypes, feat_dim)
+            labels: prototype labels (one-hot), shape: (n_prototypes, n_way+1)
         """
-        prototypes = []
-        labels = []
-        for i in range(self.n_way):
-            # extract point features belonging to current foreground class
-            feat = feats[i, ...].transpose(1,2).contiguous().view(-1, self.feat_dim) #(k_shot*num_points, feat_dim)
-            index = torch.nonzero(masks[i, ...].view(-1)).squeeze(1) #(k_shot*num_points,)
-            feat = feat[index]
-            class_prototypes = self.getMutiplePrototypes(feat, k)
-            prototypes.append(class_prototypes)
-
-            # construct label matrix
-            class_labels = torch.zeros(class_prototypes.shape[0], self.n_classes)
-            class_labels[:, i+1] = 1
-            labels.append(class_labels)
-
-        prototypes = torch.cat(prototypes, dim=0)
-        labels = torch.cat(labels, dim=0)
-
+        point_feat = feats.transpose(2,3).reshape(self.n_way, -1, self.feat_dim) #(n_way, k_shot*num_points, feat_dim)
+        fg_masks = fg_masks.reshape(self.n_way, -1).bool()
+        bg_masks = bg_masks.reshape(-1).bool()
+
+        feat = torch.cat((point_feat.reshape(-1, self.feat_dim)[bg_masks], point_feat[fg_masks]), dim=0)
+        group = torch.cat((torch.zeros(int(bg_masks.sum()), dtype=torch.long, device=feat.device),
+                           torch.nonzero(fg_masks)[:, 0] + 1)) # 0 is the background, i+1 the foreground of way i
+        group_sizes = torch.bincount(group, minlength=self.n_classes)
+        assert bool((group_sizes[1:] > 0).all())
+        # in case this support set does not contain background points, the groups are renumbered consecutively
+        group_labels, group = torch.unique(group, return_inverse=True)
+
+        # sample k seeds per group as initial centers with Farthest Point Sampling (FPS)
+        n_groups = group_labels.shape[0]
+        point_counts = torch.bincount(group, minlength=n_groups).tolist()
+        if FPS_BATCHED_RATIO:
+            # the ratio is computed in double precision, as for a python float ratio, so that ceil(ratio*n) = k
+            ratio = (k / group_sizes[group_labels].double()).clamp(max=1.).to(feat.dtype)
+            fps_index = fps(feat, group, ratio=ratio, random_start=False).unique()
+        else:
+            # one FPS call per group
+            point_offsets = np.cumsum([0] + point_counts[:-1]).tolist()
+            fps_index = torch.cat([fps(group_feat, None, ratio=min(k / group_feat.shape[0], 1.),
+                                       random_start=False).unique() + offset
+                                   for group_feat, offset in zip(feat.split(point_counts), point_offsets)])
+        prototypes = feat[fps_index]
+        prototype_group = group[fps_index]
+
+        # hard assignment of each point to the closest center of its own group, then aggregation of each cluster,
+        # optionally refined with a few k-means iterations. The points and the (sorted) sampled centers are both
+        # ordered by group, so the distances are only computed segment by segment within each group
+        prototype_counts = torch.bincount(prototype_group, minlength=n_groups).tolist()
+        prototype_offsets = np.cumsum([0] + prototype_counts[:-1]).tolist()
+        for i in range(self.n_kmeans_iters + 1):
+            assignments = torch.cat([torch.cdist(group_feat, group_prototypes).argmin(dim=1) + offset
+                                     for group_feat, group_prototypes, offset in zip(feat.split(point_counts),
+                                         prototypes.split(prototype_counts), prototype_offsets)])
+            prototypes = self.getClusterMeans(feat, assignments, prototypes)
+
+        labels = F.one_hot(group_labels[prototype_group], self.n_classes).float()
         return prototypes, labels
 
-    def getBackgroundPrototypes(self, feats, masks, k=100):
+    def knnSimilarity(self, node_feat, k=200, method='gaussian'):
         """
-        Extract background prototypes via clustering point features within background class
+        Find the k nearest neighbors of each node and their similarity.
+        Without gradient the similarity is derived from the squared distances returned by the kNN search,
+        otherwise it is recomputed from the neighbor features so that it stays differentiable.
 
         Args:
-            feats: input support features, shape: (n_way, k_shot, feat_dim, num_points)
-            masks: background binary masks, shape: (n_way, k_shot, num_points)
+            node_feat: input node features, shape: (num_nodes, feat_dim)
+            k: the number of nearest neighbors for each node to compute the similarity
+            method: 'cosine' or 'gaussian', different similarity function
         Return:
-            prototypes: background prototypes, shape: (k, feat_dim)
-            labels: background prototype labels (one-hot), shape: (k, n_way+1)
+            I: neighbor indices, shape: (num_nodes, k)
+            knn_similarity: similarity to each neighbor, shape: (num_nodes, k)
         """
-        feats = feats.transpose(2,3).contiguous().view(-1, self.feat_dim)
-        index = torch.nonzero(masks.view(-1)).squeeze(1)
-        feat = feats[index]
-        # in case this support set does not contain background points..
-        if feat.shape[0] != 0:
-            prototypes = self.getMutiplePrototypes(feat, k)
+        # kNN search for the graph, the first neighbor is the node itself
+        sq_dist, I = self.knn.search(node_feat, k + 1)
+        sq_dist = sq_dist[:, 1:]
+        I = I[:, 1:] #(num_nodes, k)
 
-            labels = torch.zeros(prototypes.shape[0], self.n_classes)
-            labels[:, 0] = 1
+        if method not in ['cosine', 'gaussian']:
+            raise NotImplementedError('Error! Distance computation method (%s) is unknown!' %method)
 
-            return prototypes, labels
+        if torch.is_grad_enabled() and node_feat.requires_grad:
+            knn_feat = node_feat[I] #(num_nodes, k, feat_dim)
+            if method == 'cosine':
+                knn_similarity = F.cosine_similarity(node_feat[:,None,:], knn_feat, dim=2)
+            else:
+                dist = torch.norm(knn_feat - node_feat[:,None,:], p=2, dim=2)
+                knn_similarity = torch.exp(-0.5*(dist/self.sigma)**2)
         else:
-            return None, None
+            sq_dist = sq_dist.clamp(min=0) #(num_nodes, k)
+            if method == 'cosine':
+                # <x, y> = (|x|^2 + |y|^2 - |x-y|^2) / 2
+                sq_norm = (node_feat**2).sum(1)
+                inner = (sq_norm[:,None] + sq_norm[I] - sq_dist) / 2
+                knn_similarity = inner / (sq_norm[:,None] * sq_norm[I]).sqrt().clamp(min=1e-8)
+            else:
+                knn_similarity = torch.exp(-0.5*sq_dist/self.sigma**2)
+            # neighbors missed by an approximate search come back with an infinite distance
+            knn_similarity = knn_similarity.masked_fill(torch.isinf(sq_dist), 0)
+        return I, knn_similarity
 
     def calculateLocalConstrainedAffinity(self, node_feat, k=200, method='gaussian'):
         """
@@ -252,34 +306,33 @@ class MultiPrototypeTransductiveInference(nn.Module):
         Return:
             A: Affinity matrix with zero diagonal, shape: (num_nodes, num_nodes)
         """
-        # kNN search for the graph
-        X = node_feat.detach().cpu().numpy()
-        # build the index with cpu version
-        index = faiss.IndexFlatL2(self.feat_dim)
-        index.add(X)
-        _, I = index.search(X, k + 1)
-        I = torch.from_numpy(I[:, 1:]).cuda() #(num_nodes, k)
+        I, knn_similarity = self.knnSimilarity(node_feat, k=k, method=method)
 
         # create the affinity matrix
-        knn_idx = I.unsqueeze(2).expand(-1, -1, self.feat_dim).contiguous().view(-1, self.feat_dim)
-        knn_feat = torch.gather(node_feat, dim=0, index=knn_idx).contiguous().view(self.num_nodes, k, self.feat_dim)
-
-        if method == 'cosine':
-            knn_similarity = F.cosine_similarity(node_feat[:,None,:], knn_feat, dim=2)
-        elif method == 'gaussian':
-            dist = F.pairwise_distance(node_feat[:,:,None], knn_feat.transpose(1,2), p=2)
-            knn_similarity = torch.exp(-0.5*(dist/self.sigma)**2)
-        else:
-            raise NotImplementedError('Error! Distance computation method (%s) is unknown!' %method)
-
-        A = torch.zeros(self.num_nodes, self.num_nodes, dtype=torch.float).cuda()
+        A = torch.zeros(self.num_nodes, self.num_nodes, dtype=torch.float, device=node_feat.device)
         A = A.scatter_(1, I, knn_similarity)
         A = A + A.transpose(0,1)
 
-        identity_matrix = torch.eye(self.num_nodes, requires_grad=False).cuda()
+        identity_matrix = torch.eye(self.num_nodes, requires_grad=False, device=node_feat.device)
         A = A * (1 - identity_matrix)
         return A
 
+    def calculateSparseAffinity(self, node_feat, k=200, method='gaussian'):
+        """
+        Same affinity as calculateLocalConstrainedAffinity, kept as a COO edge list of the symmetrized kNN graph
+        instead of a dense matrix, so memory grows with num_nodes*k rather than num_nodes^2.
+        Duplicate edges (j in kNN(i) and i in kNN(j)) are summed when the matrix is applied, as in A + A^T.
+
+        Return:
+            rows, cols: edge end points, shape: (2*num_nodes*k,)
+            values: edge weights with self-loops set to zero, shape: (2*num_nodes*k,)
+        """
+        I, knn_similarity = self.knnSimilarity(node_feat, k=k, method=method)
+
+        rows = torch.arange(self.num_nodes, device=node_feat.device).unsqueeze(1).expand(-1, k).reshape(-1)
+        cols = I.reshape(-1)
+        values = knn_similarity.reshape(-1) * (rows != cols).float()
+        return torch.cat((rows, cols)), torch.cat((cols, rows)), torch.cat((values, values))
 
     def label_propagate(self, A, Y, alpha=0.99):
         """ Label Propagation, refer to "Learning with Local and Global Consistency" NeurIPs 2003
@@ -294,14 +347,66 @@ class MultiPrototypeTransductiveInference(nn.Module):
         eps = np.finfo(float).eps
         D = A.sum(1) #(num_nodes,)
         D_sqrt_inv = torch.sqrt(1.0/(D+eps))
-        D_sqrt_inv = torch.diag_embed(D_sqrt_inv).cuda()
+        D_sqrt_inv = torch.diag_embed(D_sqrt_inv)
         S = D_sqrt_inv @ A @ D_sqrt_inv
 
         #close form solution
-        Z = torch.inverse(torch.eye(self.num_nodes).cuda() - alpha*S + eps) @ Y
+        Z = torch.inverse(torch.eye(self.num_nodes, device=A.device) - alpha*S + eps) @ Y
         return Z
 
+    def label_propagate_sparse(self, edges, Y, alpha=0.99):
+        """ Label Propagation on the sparse kNN graph, solving (I - alpha*S) Z = Y with conjugate gradient
+        Args:
+            edges: (rows, cols, values) edge list of the affinity matrix, see calculateSparseAffinity
+            Y: initial label matrix, shape: (num_nodes, n_way+1)
+            alpha: a parameter to control the amount of propagated info.
+        Return:
+            Z: label predictions, shape: (num_nodes, n_way+1)
+        """
+        rows, cols, values = edges
+        #compute symmetrically normalized edge weights of S
+        eps = np.finfo(float).eps
+        D = torch.zeros(self.num_nodes, device=Y.device).index_add(0, rows, values) #(num_nodes,)
+        D_sqrt_inv = torch.sqrt(1.0/(D+eps))
+        S_values = (D_sqrt_inv[rows] * values * D_sqrt_inv[cols]).unsqueeze(1)
+
+        def matvec(X):
+            SX = torch.zeros_like(X).index_add(0, rows, S_values * X[cols])
+            return X - alpha*SX
+
+        return conjugate_gradient(matvec, Y, max_iters=self.lp_iters, tol=self.lp_tol)
+
     def computeCrossEntropyLoss(self, query_logits, query_labels):
         """ Calculate the CrossEntropy Loss for query set
         """
         return F.cross_entropy(query_logits, query_labels)
+
+
+def conjugate_gradient(matvec, B, max_iters=200, tol=1e-4):
+    """
+    Solve M X = B for a symmetric positive definite M, each column of B being an independent system
+    Args:
+        matvec: function computing M @ X for X of shape (n, c)
+        B: right-hand sides, shape: (n, c)
+        max_iters: maximum number of iterations
+        tol: stop once the residual norm of every column is below tol * its norm in B
+    Return:
+        X: solution, shape: (n, c)
+    """
+    X = torch.zeros_like(B)
+    R = B
+    P = R
+    rs = (R*R).sum(0)
+    threshold = (tol**2) * rs
+    for i in range(max_iters):
+        MP = matvec(P)
+        pMp = (P*MP).sum(0)
+        step = torch.where(pMp > 0, rs / pMp.clamp(min=1e-30), torch.zeros_like(rs))
+        X = X + step*P
+        R = R - step*MP
+        rs_new = (R*R).sum(0)
+        if bool((rs_new <= threshold).all()):
+            break
+        P = R + torch.where(rs > 0, rs_new / rs.clamp(min=1e-30), torch.zeros_like(rs))*P
+        rs = rs_new
+    return X
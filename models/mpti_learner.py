@@ -6,16 +6,18 @@ from torch.nn import functional as F
 
 from models.mpti import MultiPrototypeTransductiveInference
 from utils.checkpoint_util import load_pretrain_checkpoint, load_model_checkpoint
+from utils.amp_util import MixedPrecision
 
 
 class MPTILearner(object):
     def __init__(self, args, mode='train'):
 
         # init model and optimizer
+        self.device = args.device
         self.model = MultiPrototypeTransductiveInference(args)
         print(self.model)
-        if torch.cuda.is_available():
-            self.model.cuda()
+        self.model.to(self.device)
+        self.amp = MixedPrecision(args.amp, self.device)
 
         if mode=='train':
             if args.use_attention:
@@ -33,14 +35,17 @@ class MPTILearner(object):
                                                           gamma=args.gamma)
             if args.model_checkpoint_path is None:
                 # load pretrained model for point cloud encoding
-                self.model = load_pretrain_checkpoint(self.model, args.pretrain_checkpoint_path)
+                self.model = load_pretrain_checkpoint(self.model, args.pretrain_checkpoint_path,
+                                                      map_location=self.device)
             else:
                 # resume from model checkpoint
                 self.model, self.optimizer = load_model_checkpoint(self.model, args.model_checkpoint_path,
-                                                                   optimizer=self.optimizer, mode='train')
+                                                                   optimizer=self.optimizer, mode='train',
+                                                                   map_location=self.device)
         elif mode=='test':
             # Load model checkpoint
-            self.model = load_model_checkpoint(self.model, args.model_checkpoint_path, mode='test')
+            self.model = load_model_checkpoint(self.model, args.model_checkpoint_path, mode='test',
+                                               map_location=self.device)
         else:
             raise ValueError('Wrong GraphLearner mode (%s)! Option:train/test' %mode)
 
@@ -57,11 +62,11 @@ class MPTILearner(object):
         [support_x, support_y, query_x, query_y] = data
         self.model.train()
 
-        query_logits, loss= self.model(support_x, support_y, query_x, query_y)
+        with self.amp.autocast():
+            query_logits, loss= self.model(support_x, support_y, query_x, query_y)
 
         self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self.amp.backward(loss, self.optimizer)
 
         self.lr_scheduler.step()
 
@@ -83,7 +88,7 @@ class MPTILearner(object):
         [support_x, support_y, query_x, query_y] = data
         self.model.eval()
 
-        with torch.no_grad():
+        with torch.no_grad(), self.amp.autocast():
             logits, loss= self.model(support_x, support_y, query_x, query_y)
             pred = F.softmax(logits, dim=1).argmax(dim=1)
             correct = torch.eq(pred, query_y).sum().item()
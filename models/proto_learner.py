@@ -1,21 +1,26 @@
 
 import torch
 import time
+import hashlib
+from collections import OrderedDict
 from torch import optim
 from torch.nn import functional as F
 
 from models.CCBR import ProtoNet
 from utils.checkpoint_util import load_pretrain_checkpoint, load_model_checkpoint
+from utils.amp_util import MixedPrecision
 
 
 class ProtoLearner(object):
     def __init__(self, args, mode='train'):
 
         # init model and optimizer
+        self.device = args.device
         self.model = ProtoNet(args)
         print(self.model)
-        if torch.cuda.is_available():
-            self.model.cuda()
+        self.model.to(self.device)
+        self.amp = MixedPrecision(args.amp, self.device)
+        self.support_cache_size = args.support_cache_size
 
         if mode=='train':
             if args.use_attention:
@@ -32,12 +37,16 @@ class ProtoLearner(object):
             self.lr_scheduler = optim.lr_scheduler.StepLR(self.optimizer, step_size=args.step_size,
                                                           gamma=args.gamma)
             # load pretrained model for point cloud encoding
-            self.model = load_pretrain_checkpoint(self.model, args.pretrain_checkpoint_path)
+            self.model = load_pretrain_checkpoint(self.model, args.pretrain_checkpoint_path,
+                                                  map_location=self.device)
         elif mode=='test':
             # Load model checkpoint
-            self.model = load_model_checkpoint(self.model, args.model_checkpoint_path, mode='test')
+            self.model = load_model_checkpoint(self.model, args.model_checkpoint_path, mode='test',
+                                               map_location=self.device)
         else:
             raise ValueError('Wrong GMMLearner mode (%s)! Option:train/test' %mode)
+        # encoded support sets, see register_support(), only valid for the current weights
+        self.support_cache = OrderedDict()
 
     def train(self, data):
         """
@@ -51,12 +60,14 @@ class ProtoLearner(object):
 
         [support_x, support_y, query_x, query_y] = data
         self.model.train()
+        # the weights are about to change, the encoded support sets are stale
+        self.support_cache.clear()
 
-        query_logits, loss = self.model(support_x, support_y, query_x, query_y)
+        with self.amp.autocast():
+            query_logits, loss = self.model(support_x, support_y, query_x, query_y)
 
         self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self.amp.backward(loss, self.optimizer)
 
         self.lr_scheduler.step()
 
@@ -67,23 +78,111 @@ class ProtoLearner(object):
         return loss, accuracy
 
 
-    def test(self, data):
+    def test(self, data, handle=None):
         """
         Args:
             support_x: support point clouds with shape (n_way, k_shot, in_channels, num_points)
             support_y: support masks (foreground) with shape (n_way, k_shot, num_points), each point \in {0,1}.
             query_x: query point clouds with shape (n_queries, in_channels, num_points)
             query_y: query labels with shape (n_queries, num_points), each point \in {0,..., n_way}
+            handle: optional support_hash() of the support set, computed before it was moved to the device
         """
         points = []
 
         [support_x, support_y, query_x, query_y] = data
         self.model.eval()
 
-        with torch.no_grad():
-            logits, loss = self.model(support_x, support_y, query_x, query_y)
+        if self.support_cache_size > 0:
+            # support sets seen recently are not encoded again
+            handle = self.register_support(support_x, support_y, handle)
+            pred, loss = self.score_queries(handle, query_x, query_y)
+        else:
+            with torch.no_grad(), self.amp.autocast():
+                logits, loss = self.model(support_x, support_y, query_x, query_y)
+                pred = F.softmax(logits, dim=1).argmax(dim=1)
+        correct = torch.eq(pred, query_y).sum().item()
+        accuracy = correct / (query_y.shape[0]*query_y.shape[1])
+
+        return pred, loss, accuracy
+
+    def register_support(self, support_x, support_y, handle=None):
+        """
+        Encode a support set once, to score any number of queries against it with score_queries().
+        The encoded support sets are kept in a LRU of support_cache_size entries (at least 1), keyed on their content.
+        Args:
+            support_x: support point clouds with shape (n_way, k_shot, in_channels, num_points)
+            support_y: support masks (foreground) with shape (n_way, k_shot, num_points)
+            handle: support_hash() of the support set if already known, preferably computed on the host tensors since
+                    hashing device tensors copies them back to the host
+        Return:
+            handle: a hash of the support content, registering the same support set again returns the same handle
+        """
+        if handle is None:
+            handle = support_hash(support_x, support_y)
+        if handle in self.support_cache:
+            self.support_cache.move_to_end(handle)
+            return handle
+
+        self.model.eval()
+        with torch.no_grad(), self.amp.autocast():
+            support_feat = self.model.getFeatures(support_x.view(-1, *support_x.shape[2:]))
+        self.support_cache[handle] = (support_feat, support_y)
+        if len(self.support_cache) > max(self.support_cache_size, 1):
+            self.support_cache.popitem(last=False)
+        return handle
+
+    def score_queries(self, handle, query_x, query_y=None):
+        """
+        Segment query point clouds with a support set registered with register_support()
+        Args:
+            handle: returned by register_support()
+            query_x: query point clouds with shape (n_queries, in_channels, num_points)
+            query_y: query labels with shape (n_queries, num_points), optional, only used for the loss
+        Return:
+            pred: predicted query labels with shape (n_queries, num_points), each point \in {0,..., n_way}
+            loss: None if query_y is not given
+        """
+        if handle not in self.support_cache:
+            raise KeyError('Support set %s is not registered or was evicted from the cache (support_cache_size=%d)'
+                           % (handle, self.support_cache_size))
+        self.support_cache.move_to_end(handle)
+        support_feat, support_y = self.support_cache[handle]
+
+        self.model.eval()
+        with torch.no_grad(), self.amp.autocast():
+            query_feat = self.model.getFeatures(query_x)
+            # predict() adapts the support features to the query in place, the cached ones must stay untouched
+            logits, loss = self.model.predict(support_feat.clone(), support_y, query_feat, query_y)
             pred = F.softmax(logits, dim=1).argmax(dim=1)
+        return pred, loss
+
+    def test_batch(self, data):
+        """
+        Evaluate several episodes with one encoder forward pass
+        Args:
+            data: same entries as test(), each with an extra leading n_episodes axis
+        Return:
+            pred: predicted query labels with shape (n_episodes, n_queries, num_points)
+            loss: loss of each episode, shape: (n_episodes,)
+            accuracy: accuracy over all the query points of the episodes
+        """
+        [support_x, support_y, query_x, query_y] = data
+        self.model.eval()
+
+        with torch.no_grad(), self.amp.autocast():
+            logits, loss = self.model.forward_batch(support_x, support_y, query_x, query_y)
+            pred = F.softmax(logits, dim=2).argmax(dim=2)
             correct = torch.eq(pred, query_y).sum().item()
-            accuracy = correct / (query_y.shape[0]*query_y.shape[1])
+            accuracy = correct / query_y.numel()
 
         return pred, loss, accuracy
+
+
+def support_hash(support_x, support_y):
+    """Hash of the content (shape, dtype and values) of a support set, meant for host tensors"""
+    h = hashlib.sha1()
+    for tensor in [support_x, support_y]:
+        tensor = tensor.detach().contiguous().cpu()
+        h.update(('%s%s' % (tuple(tensor.shape), tensor.dtype)).encode())
+        h.update(tensor.numpy().tobytes())
+    return h.hexdigest()
@@ -0,0 +1,23 @@
+""" Build the (block, class) -> point indices table for blocks generated by room2blocks.py
+
+Blocks split by the current room2blocks.py already come with the label index, this script is for older block folders.
+"""
+import os
+import sys
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BASE_DIR)
+sys.path.append(ROOT_DIR)
+
+from dataloaders.block_store import open_block_store, build_label_index
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='[Preprocessing] Build label index of blocks')
+    parser.add_argument('--data_path', default='../datasets/S3DIS/blocks_bs1_s1', help='Directory to the blocks')
+    args = parser.parse_args()
+
+    block_store = open_block_store(args.data_path)
+    build_label_index(block_store)
+    print('Label index of {0} blocks is saved to {1}'.format(len(block_store.block_names()), args.data_path))
@@ -5,26 +5,29 @@
 import os
 import glob
 import numpy as np
+import sys
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BASE_DIR)
+sys.path.append(ROOT_DIR)
+
+from dataloaders.block_store import PackedBlockWriter, LabelIndexWriter
 
 # -----------------------------------------------------------------------------
 # PREPARE BLOCK DATA FOR SUPERPOINT GRAPH GENERATION
 # -----------------------------------------------------------------------------
 
-def room2blocks(data, block_size, stride, min_npts):
-    """ Prepare block data.
+def room2block_inds(xyz, block_size, stride, min_npts):
+    """ Sweep a square window over the xy plane of a room.
     Args:
-        data: N x 7 numpy array, 012 are XYZ in meters, 345 are RGB in [0,255], 6 is the labels
-            assumes the data is not shifted (min point is not origin),
+        xyz: N x 3 numpy array of coordinates, the min point is the origin
         block_size: float, physical size of the block in meters
         stride: float, stride for block sweeping
+        min_npts: blocks with less points are discarded
     Returns:
-        blocks_list: a list of blocks, each block is a num_point x 7 np array
+        block_inds_list: a list of int64 arrays, the indices of the points of each block
     """
     assert (stride <= block_size)
 
-    xyz = data[:,:3]
-    xyz_min = np.amin(xyz, axis=0)
-    xyz -= xyz_min
     xyz_max = np.amax(xyz, axis=0)
 
     # Get the corner location for our sampling blocks
@@ -38,7 +41,7 @@ def room2blocks(data, block_size, stride, min_npts):
             ybeg_list.append(j * stride)
 
     # Collect blocks
-    blocks_list = []
+    block_inds_list = []
     for idx in range(len(xbeg_list)):
         xbeg = xbeg_list[idx]
         ybeg = ybeg_list[idx]
@@ -48,10 +51,26 @@ def room2blocks(data, block_size, stride, min_npts):
         if np.sum(cond) < min_npts:  # discard block if there are less than 100 pts.
             continue
 
-        block = data[cond, :]
-        blocks_list.append(block)
+        block_inds_list.append(np.nonzero(cond)[0])
+
+    return block_inds_list
+
+
+def room2blocks(data, block_size, stride, min_npts):
+    """ Prepare block data.
+    Args:
+        data: N x 7 numpy array, 012 are XYZ in meters, 345 are RGB in [0,255], 6 is the labels
+            assumes the data is not shifted (min point is not origin),
+        block_size: float, physical size of the block in meters
+        stride: float, stride for block sweeping
+    Returns:
+        blocks_list: a list of blocks, each block is a num_point x 7 np array
+    """
+    xyz = data[:,:3]
+    xyz_min = np.amin(xyz, axis=0)
+    xyz -= xyz_min
 
-    return blocks_list
+    return [data[block_inds, :] for block_inds in room2block_inds(xyz, block_size, stride, min_npts)]
 
 
 def room2blocks_wrapper(room_path, block_size, stride, min_npts):
@@ -76,6 +95,8 @@ if __name__ == '__main__':
                                                                 'stride should be not larger than block size')
     parser.add_argument('--min_npts', type=int, default=1000, help='the minimum number of points in a block,'
                                                                   'if less than this threshold, the block is discarded')
+    parser.add_argument('--format', default='npy', help='npy|packed, write one npy file per block or '
+                                                        'a single packed container with a block index')
 
     args = parser.parse_args()
 
@@ -83,10 +104,18 @@ if __name__ == '__main__':
     BLOCK_SIZE = args.block_size
     STRIDE = args.stride
     MIN_NPTS = args.min_npts
-    SAVE_PATH = os.path.join(os.path.dirname(DATA_PATH), 'blocks_bs{0}_s{1}'.format(BLOCK_SIZE, STRIDE), 'data')
-    if not os.path.exists(SAVE_PATH): os.makedirs(SAVE_PATH)
+    BLOCKS_PATH = os.path.join(os.path.dirname(DATA_PATH), 'blocks_bs{0}_s{1}'.format(BLOCK_SIZE, STRIDE))
+    SAVE_PATH = os.path.join(BLOCKS_PATH, 'data')
+    if args.format == 'npy':
+        if not os.path.exists(SAVE_PATH): os.makedirs(SAVE_PATH)
+    elif args.format == 'packed':
+        if not os.path.exists(BLOCKS_PATH): os.makedirs(BLOCKS_PATH)
+        packed_writer = PackedBlockWriter(BLOCKS_PATH)
+    else:
+        raise NotImplementedError('Unknown format %s! [Options: npy/packed]' % args.format)
+    label_index_writer = LabelIndexWriter(BLOCKS_PATH)
 
-    file_paths = glob.glob(os.path.join(DATA_PATH, 'data', '*.npy'))
+    file_paths = sorted(glob.glob(os.path.join(DATA_PATH, 'data', '*.npy')))
     print('{} scenes to be split...'.format(len(file_paths)))
 
     block_cnt = 0
@@ -97,7 +126,15 @@ if __name__ == '__main__':
         block_cnt += len(blocks_list)
 
         for i, block_data in enumerate(blocks_list):
-            block_filename = room_name + '_block_' + str(i) + '.npy'
-            np.save(os.path.join(SAVE_PATH, block_filename), block_data)
+            block_name = room_name + '_block_' + str(i)
+            if args.format == 'packed':
+                packed_writer.add(block_name, block_data)
+            else:
+                np.save(os.path.join(SAVE_PATH, block_name + '.npy'), block_data)
+            label_index_writer.add(block_name, block_data[:, 6])
+
+    if args.format == 'packed':
+        packed_writer.close()
+    label_index_writer.close()
 
     print("Total samples: {0}".format(block_cnt))
\ No newline at end of file
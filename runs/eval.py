@@ -8,94 +8,100 @@ import importlib
 importlib.reload(sys)
 
 import torch
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, BatchSampler, SequentialSampler
 
-from dataloaders.loader import MyTestDataset, batch_test_task_collate
-from models.proto_learner import ProtoLearner
+from dataloaders.loader import MyTestDataset, batch_test_task_collate, batch_test_tasks_collate, remap_labels
+from models.proto_learner import ProtoLearner, support_hash
 from models.mpti_learner import MPTILearner
-from utils.cuda_util import cast_cuda
+from utils.cuda_util import cast_device
+from utils.metric_util import ConfusionMatrix
 from utils.logger import init_logger
 
 
-def evaluate_metric(logger, pred_labels_list, gt_labels_list, label2class_list, test_classes):
+def episode_label2index(label2class, test_classes):
     """
-    :param pred_labels_list: a list of np array, each entry with shape (n_queries*n_way, num_points).
-    :param gt_labels_list: a list of np array, each entry with shape (n_queries*n_way, num_points).
+    LUT from the labels of one episode (0 indicates background, i indicates label2class[i-1])
+    to indices in [background] + test_classes
+    """
+    return np.concatenate([[0], remap_labels(np.asarray(label2class), test_classes)])
+
+
+def update_episode_metric(metric, pred_labels, gt_labels, label2class, test_classes):
+    """
+    Accumulate the predictions of one episode into `metric` (a ConfusionMatrix over [background] + test_classes)
+    :param pred_labels: np array or tensor with shape (n_queries*n_way, num_points), tensors are counted on device
+    :param gt_labels: np array or tensor with shape (n_queries*n_way, num_points)
+    :param label2class: np array with shape (n_way,)
+    """
+    label2index = episode_label2index(label2class, test_classes)
+    if torch.is_tensor(pred_labels):
+        label2index = torch.from_numpy(label2index).to(pred_labels.device)
+        metric.update(label2index[pred_labels.long()], label2index[gt_labels.to(pred_labels.device).long()])
+    else:
+        metric.update(label2index[pred_labels.astype(np.int64)], label2index[gt_labels.astype(np.int64)])
+
+
+def evaluate_metric(logger, metric, test_classes):
+    """
+    :param metric: ConfusionMatrix accumulated with update_episode_metric over all test episodes
     :param test_classes: a list of np array, each entry with shape (n_way,)
     :return: iou: scaler
     """
-    assert len(pred_labels_list) == len(gt_labels_list) == len(label2class_list)
-
     logger.cprint('*****Test Classes: {0}*****'.format(test_classes))
 
     NUM_CLASS = len(test_classes) + 1 # add 1 to consider background class
-    gt_classes = [0 for _ in range(NUM_CLASS)]
-    positive_classes = [0 for _ in range(NUM_CLASS)]
-    true_positive_classes = [0 for _ in range(NUM_CLASS)]
-
-    for i, batch_gt_labels in enumerate(gt_labels_list):
-        batch_pred_labels = pred_labels_list[i] #(n_queries*n_way, num_points)
-        label2class = label2class_list[i] #(n_way,)
-
-        for j in range(batch_pred_labels.shape[0]):
-            for k in range(batch_pred_labels.shape[1]):
-                gt = int(batch_gt_labels[j, k])
-                pred = int(batch_pred_labels[j,k])
-
-                if gt == 0: # 0 indicate background class
-                    gt_index = 0
-                else:
-                    gt_class = label2class[gt-1] # the ground truth class in the dataset
-                    gt_index = test_classes.index(gt_class) + 1
-                gt_classes[gt_index] += 1
-
-                if pred == 0:
-                    pred_index = 0
-                else:
-                    pred_class = label2class[pred-1]
-                    pred_index = test_classes.index(pred_class) + 1
-                positive_classes[pred_index] += 1
-
-                true_positive_classes[gt_index] += int(gt == pred)
-
-    iou_list = []
+    oa, iou_list, precision_list, recall_list = metric.metrics()
     for c in range(NUM_CLASS):
-        iou = true_positive_classes[c] / float(gt_classes[c] + positive_classes[c] - true_positive_classes[c])
-        logger.cprint('----- [class %d]  IoU: %f -----'% (c, iou))
-        iou_list.append(iou)
+        logger.cprint('----- [class %d]  IoU: %f | Precision: %f | Recall: %f -----'
+                      % (c, iou_list[c], precision_list[c], recall_list[c]))
+    logger.cprint('----- Overall accuracy: %f -----' % oa)
 
-    mean_IoU = np.array(iou_list[1:]).mean()
+    mean_IoU = metric.mean_iou()
 
     return mean_IoU
 
 
-def test_few_shot(test_loader, learner, logger, test_classes):
-
+def test_few_shot(test_loader, learner, logger, test_classes, batched=False):
+    """
+    :param batched: if True, each item of test_loader stacks several episodes (see batch_test_tasks_collate)
+                    and they are evaluated together with learner.test_batch
+    """
     total_loss = 0
-
-    predicted_label_total = []
-    gt_label_total = []
-    label2class_total = []
+    num_episodes = 0
+    # per-class counts are accumulated episode by episode instead of keeping all the predictions
+    metric = ConfusionMatrix(len(test_classes) + 1)
 
     for batch_idx, (data, sampled_classes) in enumerate(test_loader):
         query_label = data[-1]
-
-        if torch.cuda.is_available():
-            data = cast_cuda(data)
-
-        query_pred, loss, accuracy = learner.test(data)
-        total_loss += loss.detach().item()
+        handle = None
+        if not batched and isinstance(learner, ProtoLearner) and learner.support_cache_size > 0:
+            # the support set is hashed on the host, before it is moved to the device
+            handle = support_hash(data[0], data[1])
+
+        data = cast_device(data, learner.device)
+
+        if batched:
+            query_pred, loss, accuracy = learner.test_batch(data)
+            total_loss += loss.sum().item()
+            num_episodes += loss.shape[0]
+            for i in range(loss.shape[0]):
+                update_episode_metric(metric, query_pred[i], query_label[i], sampled_classes[i], test_classes)
+            loss = loss.mean()
+        else:
+            if handle is None:
+                query_pred, loss, accuracy = learner.test(data)
+            else:
+                query_pred, loss, accuracy = learner.test(data, handle=handle)
+            total_loss += loss.detach().item()
+            num_episodes += 1
+            update_episode_metric(metric, query_pred, query_label, sampled_classes, test_classes)
 
         if (batch_idx+1) % 50 == 0:
-            logger.cprint('[Eval] Iter: %d | Loss: %.4f | %s' % ( batch_idx+1, loss.detach().item(), str(datetime.now())))
+            logger.cprint('[Eval] Iter: %d | Loss: %.4f | Running mIoU: %f | %s' % (batch_idx+1,
+                          loss.detach().item(), metric.mean_iou(skip_missing=True), str(datetime.now())))
 
-        #compute metric for predictions
-        predicted_label_total.append(query_pred.cpu().detach().numpy())
-        gt_label_total.append(query_label.numpy())
-        label2class_total.append(sampled_classes)
-
-    mean_loss = total_loss/len(test_loader)
-    mean_IoU = evaluate_metric(logger, predicted_label_total, gt_label_total, label2class_total, test_classes)
+    mean_loss = total_loss/num_episodes
+    mean_IoU = evaluate_metric(logger, metric, test_classes)
     return mean_loss, mean_IoU
 
 
@@ -111,10 +117,19 @@ def eval(args):
     TEST_DATASET = MyTestDataset(args.data_path, args.dataset, cvfold=args.cvfold,
                                  num_episode_per_comb=args.n_episode_test,
                                  n_way=args.n_way, k_shot=args.k_shot, n_queries=args.n_queries,
-                                 num_point=args.pc_npts, pc_attribs=args.pc_attribs,  mode='test')
+                                 num_point=args.pc_npts, pc_attribs=args.pc_attribs,  mode='test',
+                                 n_workers=args.n_workers)
     TEST_CLASSES = list(TEST_DATASET.classes)
-    TEST_LOADER = DataLoader(TEST_DATASET, batch_size=1, shuffle=False, collate_fn=batch_test_task_collate)
-
-    test_loss, mean_IoU = test_few_shot(TEST_LOADER, learner, logger, TEST_CLASSES)
+    # only the ProtoNet learner can encode several episodes in one forward pass
+    batched = args.eval_batch_size > 1 and hasattr(learner, 'test_batch')
+    if batched:
+        # each batch of episodes is sliced from the archive in one read
+        TEST_LOADER = DataLoader(TEST_DATASET, batch_size=None, collate_fn=batch_test_tasks_collate,
+                                 sampler=BatchSampler(SequentialSampler(TEST_DATASET), args.eval_batch_size,
+                                                      drop_last=False))
+    else:
+        TEST_LOADER = DataLoader(TEST_DATASET, batch_size=1, shuffle=False, collate_fn=batch_test_task_collate)
+
+    test_loss, mean_IoU = test_few_shot(TEST_LOADER, learner, logger, TEST_CLASSES, batched=batched)
 
     logger.cprint('\n=====[TEST] Loss: %.4f | Mean IoU: %f =====\n' %(test_loss, mean_IoU))
@@ -6,13 +6,15 @@ from torch import optim
 from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 
-from runs.eval import evaluate_metric
+from runs.eval import evaluate_metric, update_episode_metric
 from runs.pre_train import DGCNNSeg
 from models.dgcnn import DGCNN
 from dataloaders.loader import MyTestDataset, batch_test_task_collate, augment_pointcloud
 from utils.logger import init_logger
-from utils.cuda_util import cast_cuda
+from utils.cuda_util import cast_device
+from utils.amp_util import MixedPrecision
 from utils.checkpoint_util import load_pretrain_checkpoint
+from utils.metric_util import ConfusionMatrix
 
 
 class FineTuner(object):
@@ -24,15 +26,16 @@ class FineTuner(object):
         self.n_points = args.pc_npts
 
         # init model and optimizer
+        self.device = args.device
         self.model = DGCNNSeg(args, self.n_way+1)
         print(self.model)
-        if torch.cuda.is_available():
-            self.model.cuda()
+        self.model.to(self.device)
+        self.amp = MixedPrecision(args.amp, self.device)
 
         self.optimizer = torch.optim.Adam(self.model.segmenter.parameters(), lr=args.lr)
 
         # load pretrained model for point cloud encoding
-        self.model = load_pretrain_checkpoint(self.model, args.pretrain_checkpoint_path)
+        self.model = load_pretrain_checkpoint(self.model, args.pretrain_checkpoint_path, map_location=self.device)
 
 
     def train(self, support_x, support_y):
@@ -41,13 +44,12 @@ class FineTuner(object):
             support_x: support point clouds with shape (n_way*k_shot, in_channels, num_points)
             support_y: support masks (foreground) with shape (n_way*k_shot, num_points), each point \in {0,..., n_way}
         """
-        support_logits = self.model(support_x)
-
-        train_loss = F.cross_entropy(support_logits, support_y)
+        with self.amp.autocast():
+            support_logits = self.model(support_x)
+            train_loss = F.cross_entropy(support_logits, support_y)
 
         self.optimizer.zero_grad()
-        train_loss.backward()
-        self.optimizer.step()
+        self.amp.backward(train_loss, self.optimizer)
 
         return train_loss
 
@@ -60,7 +62,7 @@ class FineTuner(object):
 
         self.model.eval()
 
-        with torch.no_grad():
+        with torch.no_grad(), self.amp.autocast():
             query_logits = self.model(query_x)
             test_loss = F.cross_entropy(query_logits, query_y)
 
@@ -100,7 +102,8 @@ def finetune(args):
     DATASET = MyTestDataset(args.data_path, args.dataset, cvfold=args.cvfold,
                                  num_episode_per_comb=args.n_episode_test,
                                  n_way=args.n_way, k_shot=args.k_shot, n_queries=args.n_queries,
-                                 num_point=args.pc_npts, pc_attribs=args.pc_attribs, mode='test')
+                                 num_point=args.pc_npts, pc_attribs=args.pc_attribs, mode='test',
+                                 n_workers=args.n_workers)
     CLASSES = list(DATASET.classes)
     DATA_LOADER = DataLoader(DATASET, batch_size=1, collate_fn=batch_test_task_collate)
     WRITER = SummaryWriter(log_dir=args.log_dir)
@@ -108,17 +111,14 @@ def finetune(args):
     #Init model and optimizer
     FT = FineTuner(args)
 
-    predicted_label_total = []
-    gt_label_total = []
-    label2class_total = []
+    metric = ConfusionMatrix(len(CLASSES) + 1)
 
     global_iter = 0
     for batch_idx, (data, sampled_classes) in enumerate(DATA_LOADER):
         query_label = data[-1]
         data[1] = support_mask_to_label(data[1], args.n_way, args.k_shot, args.pc_npts)
 
-        if torch.cuda.is_available():
-            data = cast_cuda(data)
+        data = cast_device(data, FT.device)
 
         [support_x, support_y, query_x, query_y] = data
         support_x = support_x.view(args.n_way * args.k_shot, -1, args.pc_npts)
@@ -141,9 +141,7 @@ def finetune(args):
             '=====[Valid] Batch_idx: %d | Loss: %.4f =====' % (batch_idx, test_loss.item()))
 
         #compute metric for predictions
-        predicted_label_total.append(query_pred.cpu().detach().numpy())
-        gt_label_total.append(query_label.numpy())
-        label2class_total.append(sampled_classes)
+        update_episode_metric(metric, query_pred.detach(), query_label, sampled_classes, CLASSES)
 
-    mean_IoU = evaluate_metric(logger, predicted_label_total, gt_label_total, label2class_total, CLASSES)
+    mean_IoU = evaluate_metric(logger, metric, CLASSES)
     logger.cprint('\n=====[Test] Mean IoU: %f =====\n' % mean_IoU)
@@ -0,0 +1,227 @@
+""" Few-shot segmentation of whole rooms
+
+A room is tiled into blocks as in preprocess/room2blocks.py, the points of each block are sampled (or chunked) into
+clouds of pc_npts points, and the clouds are encoded in batches against a support set encoded once. Every point of
+the room then takes the votes of its nearest sampled point in each block containing it.
+"""
+import os
+import ast
+import math
+import time
+import numpy as np
+
+import torch
+
+from dataloaders.loader import sample_K_pointclouds, build_pointcloud, remap_labels
+from dataloaders.block_store import open_block_store
+from models.proto_learner import ProtoLearner
+from models.mpti_learner import MPTILearner
+from preprocess.room2blocks import room2block_inds
+from utils.metric_util import ConfusionMatrix
+from utils.logger import init_logger
+
+
+def sample_block(block_inds, num_point, mode='sample'):
+    """
+    Split the points of one block into clouds of num_point points
+    :param block_inds: indices of the points of the block
+    :param mode: 'sample' draws one cloud (with replacement if the block is smaller), 'chunk' covers every point
+                 with ceil(n/num_point) disjoint clouds, the last one completed with random points of the block
+    :return: list of index arrays of length num_point
+    """
+    if mode == 'sample':
+        return [np.random.choice(block_inds, num_point, replace=len(block_inds) < num_point)]
+    elif mode == 'chunk':
+        block_inds = np.random.permutation(block_inds)
+        n_chunks = int(math.ceil(len(block_inds) / float(num_point)))
+        padding = np.random.choice(block_inds, n_chunks*num_point - len(block_inds))
+        return list(np.concatenate([block_inds, padding]).reshape(n_chunks, num_point))
+    else:
+        raise NotImplementedError('Unknown sampling mode %s! [Options: sample/chunk]' % mode)
+
+
+def nearest_inds(query_xyz, ref_xyz, device, chunk_size=8192):
+    """Index of the nearest reference point of each query point, shape: (num_query,)"""
+    ref_xyz = torch.from_numpy(ref_xyz).float().to(device)
+    nearest = []
+    for start in range(0, query_xyz.shape[0], chunk_size):
+        chunk = torch.from_numpy(query_xyz[start:start+chunk_size]).float().to(device)
+        nearest.append(torch.cdist(chunk, ref_xyz).argmin(dim=1).cpu().numpy())
+    return np.concatenate(nearest)
+
+
+class RoomSegmenter(object):
+    """
+    Batched inference engine over the blocks of a room with a fixed support set.
+    Parameters:
+      learner: ProtoLearner or MPTILearner in test mode
+      batch_size: number of clouds per encoder pass, rounded up to a multiple of group_size
+      group_size: number of query clouds scored together, as in the episodes the model was trained on
+                  (ProtoNet pairs the query and support clouds, MPTI builds one graph per group)
+    """
+    def __init__(self, learner, num_point, pc_attribs, batch_size=8, group_size=1, block_size=1., stride=1.,
+                 sampling='sample'):
+        self.learner = learner
+        self.model = learner.model
+        self.device = learner.device
+        self.amp = learner.amp
+        self.num_point = num_point
+        self.pc_attribs = pc_attribs
+        self.group_size = group_size
+        self.batch_size = int(math.ceil(batch_size / float(group_size))) * group_size
+        self.block_size = block_size
+        self.stride = stride
+        self.sampling = sampling
+        self.support_feat = None
+
+    def set_support(self, support_x, support_y):
+        """
+        Encode the support set once for all the blocks
+        Args:
+            support_x: support point clouds with shape (n_way, k_shot, in_channels, num_points)
+            support_y: support masks (foreground) with shape (n_way, k_shot, num_points)
+        """
+        self.model.eval()
+        support_x = support_x.to(self.device)
+        with torch.no_grad(), self.amp.autocast():
+            self.support_feat = self.model.getFeatures(support_x.view(-1, *support_x.shape[2:]))
+        self.support_y = support_y.to(self.device)
+
+    def predict_clouds(self, clouds):
+        """
+        :param clouds: np array with shape (n_clouds, num_points, in_channels), n_clouds a multiple of group_size
+        :return: predicted labels in {0,..., n_way}, shape: (n_clouds, num_points)
+        """
+        query_x = torch.from_numpy(clouds.astype(np.float32)).transpose(1, 2).to(self.device)
+        preds = []
+        with torch.no_grad():
+            with self.amp.autocast():
+                query_feat = self.model.getFeatures(query_x)
+            # the prototypes and the scoring run in fp32, predict() may adapt the support features in place
+            for start in range(0, query_feat.shape[0], self.group_size):
+                logits, _ = self.model.predict(self.support_feat.float().clone(), self.support_y,
+                                               query_feat[start:start+self.group_size].float(), None)
+                preds.append(logits.argmax(dim=1))
+        return torch.cat(preds).cpu().numpy()
+
+    def segment(self, room):
+        """
+        Args:
+            room: N x 6 (or more) numpy array, 012 are XYZ in meters, 345 are RGB in [0,255]
+        Return:
+            pred: predicted label of every point in {0,..., n_way}, 0 is the background, shape: (N,)
+            stats: dict with the number of blocks, clouds and sampled points, and the elapsed time in seconds
+        """
+        if self.support_feat is None:
+            raise ValueError('The support set must be given with set_support() before segmenting rooms!')
+        start_time = time.time()
+        n_classes = self.support_y.shape[0] + 1
+        xyz = room[:, 0:3] - np.amin(room[:, 0:3], axis=0)
+        rgb = room[:, 3:6] / 255.
+
+        blocks = room2block_inds(xyz, self.block_size, self.stride, min_npts=1)
+        samples = [inds for block_inds in blocks for inds in sample_block(block_inds, self.num_point, self.sampling)]
+
+        # votes of the sampled points
+        votes = np.zeros((room.shape[0], n_classes), dtype=np.int32)
+        for start in range(0, len(samples), self.batch_size):
+            batch = samples[start:start+self.batch_size]
+            n_valid = len(batch)
+            batch += [batch[-1]] * (-n_valid % self.group_size)
+            clouds = np.stack([build_pointcloud(xyz[inds].copy(), rgb[inds], self.pc_attribs, False, None)
+                               for inds in batch])
+            preds = self.predict_clouds(clouds)[:n_valid]
+            for inds, pred in zip(batch, preds):
+                np.add.at(votes, (inds, pred), 1)
+
+        # the points that were not sampled take the votes of their nearest sampled point in each of their blocks
+        stitched = votes.copy()
+        sampled = votes.sum(axis=1) > 0
+        for block_inds in blocks:
+            missing = block_inds[~sampled[block_inds]]
+            if len(missing) == 0:
+                continue
+            reference = block_inds[sampled[block_inds]]
+            stitched[missing] += votes[reference[nearest_inds(xyz[missing], xyz[reference], self.device)]]
+
+        stats = {'n_blocks': len(blocks), 'n_clouds': len(samples), 'n_sampled_points': len(samples)*self.num_point,
+                 'seconds': time.time() - start_time}
+        return stitched.argmax(axis=1), stats
+
+
+def load_support(args):
+    """
+    Sample the support clouds from the blocks of args.data_path: args.support_blocks lists, for each of the n_way
+    classes of args.support_classes, the k_shot blocks containing it
+    """
+    block_store = open_block_store(args.data_path)
+    support_ptclouds = []
+    support_masks = []
+    for support_class, block_names in zip(args.support_classes, args.support_blocks):
+        ptclouds, masks = sample_K_pointclouds(block_store, args.pc_npts, args.pc_attribs, False, None,
+                                               block_names, support_class, args.support_classes, is_support=True)
+        support_ptclouds.append(ptclouds)
+        support_masks.append(masks)
+    support_x = torch.from_numpy(np.stack(support_ptclouds).astype(np.float32)).transpose(2, 3)
+    support_y = torch.from_numpy(np.stack(support_masks).astype(np.int32))
+    return support_x, support_y
+
+
+def parse_infer_args(args):
+    """
+    Parse the support set given on the command line (args.support_classes/args.support_blocks) in place and check
+    the whole-room inference arguments, raising a ValueError for the first invalid one. Called by main.py at startup.
+    """
+    if args.room_path is None:
+        raise ValueError('--room_path is required for the %s phase' % args.phase)
+    if not os.path.exists(os.path.join(args.model_checkpoint_path, 'checkpoint.tar')):
+        raise ValueError('--model_checkpoint_path (%s) has no checkpoint.tar' % args.model_checkpoint_path)
+    for option in ['support_classes', 'support_blocks']:
+        try:
+            setattr(args, option, ast.literal_eval(getattr(args, option)))
+        except (ValueError, SyntaxError):
+            raise ValueError('--%s (%s) is not a valid python literal' % (option, getattr(args, option)))
+    if not isinstance(args.support_classes, (list, tuple)) or not isinstance(args.support_blocks, (list, tuple)) \
+            or len(args.support_classes) != args.n_way or len(args.support_blocks) != args.n_way \
+            or any(not isinstance(blocks, (list, tuple)) or len(blocks) != args.k_shot
+                   for blocks in args.support_blocks):
+        raise ValueError('--support_classes/--support_blocks must give n_way=%d classes with k_shot=%d blocks each'
+                         % (args.n_way, args.k_shot))
+
+
+def infer(args):
+    """Segment the rooms of args.room_path, the arguments are parsed and checked by parse_infer_args beforehand"""
+    logger = init_logger(args.log_dir, args)
+
+    if args.phase == '2CBRinfer':
+        learner = ProtoLearner(args, mode='test')
+    elif args.phase == 'mptiinfer':
+        learner = MPTILearner(args, mode='test')
+
+    segmenter = RoomSegmenter(learner, args.pc_npts, args.pc_attribs, batch_size=args.infer_batch_size,
+                              group_size=args.n_way*args.n_queries, block_size=args.infer_block_size,
+                              stride=args.infer_stride, sampling=args.infer_sampling)
+    segmenter.set_support(*load_support(args))
+    logger.cprint('=== Support classes: {0} | Support blocks: {1} ==='.format(args.support_classes,
+                                                                           args.support_blocks))
+
+    for room_path in args.room_path.split(','):
+        room = np.load(room_path)
+        pred, stats = segmenter.segment(room)
+        logger.cprint('[Infer] %s | %d points | %d blocks | %d clouds | %.2f s | %.0f points/sec '
+                      '(%.0f sampled points/sec)' % (room_path, room.shape[0], stats['n_blocks'], stats['n_clouds'],
+                                                     stats['seconds'], room.shape[0] / stats['seconds'],
+                                                     stats['n_sampled_points'] / stats['seconds']))
+
+        if room.shape[1] > 6:
+            # labelled room, IoU over the background and the support classes
+            metric = ConfusionMatrix(args.n_way + 1)
+            metric.update(pred, remap_labels(room[:, 6].astype(np.int64), args.support_classes))
+            oa, iou = metric.metrics()[:2]
+            logger.cprint('[Infer] %s | Overall accuracy: %f | IoU per class: %s | mIoU: %f'
+                          % (room_path, oa, str(iou), metric.mean_iou()))
+
+        # 0 is the background, i is support_classes[i-1]
+        output_path = os.path.join(args.log_dir, os.path.basename(room_path)[:-4] + '_pred.npy')
+        np.save(output_path, pred.astype(np.int64))
+        logger.cprint('[Infer] Predictions saved to %s' % output_path)
@@ -10,15 +10,20 @@ from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 
 from dataloaders.loader import MyPretrainDataset
+from dataloaders.block_store import open_block_store
 from models.dgcnn import DGCNN
 from utils.logger import init_logger
 from utils.checkpoint_util import save_pretrain_checkpoint
+from utils.metric_util import ConfusionMatrix, confusion_metrics
+from utils.amp_util import MixedPrecision
 
 
 class DGCNNSeg(nn.Module):
     def __init__(self, args, num_classes):
         super(DGCNNSeg, self).__init__()
-        self.encoder = DGCNN(args.edgeconv_widths, args.dgcnn_mlp_widths, args.pc_in_dim, k=args.dgcnn_k, return_edgeconvs=True)
+        self.encoder = DGCNN(args.edgeconv_widths, args.dgcnn_mlp_widths, args.pc_in_dim, k=args.dgcnn_k, return_edgeconvs=True,
+                             knn_chunk_size=args.dgcnn_knn_chunk, edgeconv=args.dgcnn_edgeconv,
+                             static_graph=args.dgcnn_static_graph)
         in_dim = args.dgcnn_mlp_widths[-1]
         for edgeconv_width in args.edgeconv_widths:
             in_dim += edgeconv_width[-1]
@@ -44,39 +49,22 @@ class DGCNNSeg(nn.Module):
         return logits
 
 
-def metric_evaluate(predicted_label, gt_label, NUM_CLASS):
+def metric_evaluate(conf):
     """
-    :param predicted_label: (B,N) tensor
-    :param gt_label: (B,N) tensor
+    :param conf: (NUM_CLASS, NUM_CLASS) confusion matrix accumulated over the validation set (see confusion_matrix)
     :return: iou: scaler
     """
-    gt_classes = [0 for _ in range(NUM_CLASS)]
-    positive_classes = [0 for _ in range(NUM_CLASS)]
-    true_positive_classes = [0 for _ in range(NUM_CLASS)]
-
-    for i in range(gt_label.size()[0]):
-        pred_pc = predicted_label[i]
-        gt_pc = gt_label[i]
-
-        for j in range(gt_pc.shape[0]):
-            gt_l = int(gt_pc[j])
-            pred_l = int(pred_pc[j])
-            gt_classes[gt_l] += 1
-            positive_classes[pred_l] += 1
-            true_positive_classes[gt_l] += int(gt_l == pred_l)
-
-    oa = sum(true_positive_classes)/float(sum(positive_classes))
+    NUM_CLASS = conf.shape[0]
+    oa, iou_list, precision_list, recall_list = confusion_metrics(conf)
     print('Overall accuracy: {0}'.format(oa))
-    iou_list = []
 
     for i in range(NUM_CLASS):
-        iou_class = true_positive_classes[i] / float(gt_classes[i]+positive_classes[i]-true_positive_classes[i])
-        print('Class_%d: iou_class is %f' % (i, iou_class))
-        iou_list.append(iou_class)
+        print('Class_%d: iou_class is %f | precision is %f | recall is %f'
+              % (i, iou_list[i], precision_list[i], recall_list[i]))
 
     mean_IoU = np.array(iou_list[1:]).mean()
 
-    return oa, mean_IoU, iou_list
+    return oa, mean_IoU, list(iou_list)
 
 
 def pretrain(args):
@@ -89,12 +77,13 @@ def pretrain(args):
                          'jitter': args.pc_augm_jitter
                          }
 
+    BLOCK_STORE = open_block_store(args.data_path, cache_size=args.block_cache_size)
     if args.dataset == 's3dis':
         from dataloaders.s3dis import S3DISDataset
-        DATASET = S3DISDataset(args.cvfold, args.data_path)
+        DATASET = S3DISDataset(args.cvfold, args.data_path, block_store=BLOCK_STORE)
     elif args.dataset == 'scannet':
         from dataloaders.scannet import ScanNetDataset
-        DATASET = ScanNetDataset(args.cvfold, args.data_path)
+        DATASET = ScanNetDataset(args.cvfold, args.data_path, block_store=BLOCK_STORE)
     else:
         raise NotImplementedError('Unknown dataset %s!' % args.dataset)
 
@@ -104,11 +93,13 @@ def pretrain(args):
 
     TRAIN_DATASET = MyPretrainDataset(args.data_path, CLASSES, CLASS2SCANS, mode='train',
                                       num_point=args.pc_npts, pc_attribs=args.pc_attribs,
-                                      pc_augm=args.pc_augm, pc_augm_config=PC_AUGMENT_CONFIG)
+                                      pc_augm=args.pc_augm, pc_augm_config=PC_AUGMENT_CONFIG,
+                                      block_store=BLOCK_STORE)
 
     VALID_DATASET = MyPretrainDataset(args.data_path, CLASSES, CLASS2SCANS, mode='test',
                                       num_point=args.pc_npts, pc_attribs=args.pc_attribs,
-                                      pc_augm=args.pc_augm, pc_augm_config=PC_AUGMENT_CONFIG)
+                                      pc_augm=args.pc_augm, pc_augm_config=PC_AUGMENT_CONFIG,
+                                      block_store=BLOCK_STORE)
 
     logger.cprint('=== Pre-train Dataset (classes: {0}) | Train: {1} blocks | Valid: {2} blocks ==='.format(
                                                      CLASSES, len(TRAIN_DATASET), len(VALID_DATASET)))
@@ -124,8 +115,8 @@ def pretrain(args):
     # Init model and optimizer
     model = DGCNNSeg(args, num_classes=NUM_CLASSES)
     print(model)
-    if torch.cuda.is_available():
-        model.cuda()
+    model.to(args.device)
+    amp = MixedPrecision(args.amp, args.device)
 
     optimizer = optim.Adam([{'params': model.encoder.parameters(), 'lr': args.pretrain_lr}, \
                            {'params': model.segmenter.parameters(), 'lr': args.pretrain_lr}], \
@@ -138,17 +129,16 @@ def pretrain(args):
     global_iter = 0
     for epoch in range(args.n_iters):
         for batch_idx, (ptclouds, labels) in enumerate(TRAIN_LOADER):
-            if torch.cuda.is_available():
-                ptclouds = ptclouds.cuda()
-                labels = labels.cuda()
+            ptclouds = ptclouds.to(args.device)
+            labels = labels.to(args.device)
 
-            logits = model(ptclouds)
-            loss = F.cross_entropy(logits, labels)
+            with amp.autocast():
+                logits = model(ptclouds)
+                loss = F.cross_entropy(logits, labels)
 
             # Loss backwards and optimizer updates
             optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            amp.backward(loss, optimizer)
 
             WRITER.add_scalar('Train/loss', loss, global_iter)
             logger.cprint('=====[Train] Epoch: %d | Iter: %d | Loss: %.4f =====' % (epoch, batch_idx, loss.item()))
@@ -157,32 +147,28 @@ def pretrain(args):
         lr_scheduler.step()
 
         if (epoch+1) % args.eval_interval == 0:
-            pred_total = []
-            gt_total = []
+            # the confusion matrix is counted batch by batch on the device of the predictions
+            metric = ConfusionMatrix(NUM_CLASSES)
             with torch.no_grad():
                 for i, (ptclouds, labels) in enumerate(VALID_LOADER):
-                    gt_total.append(labels.detach())
-
-                    if torch.cuda.is_available():
-                        ptclouds = ptclouds.cuda()
-                        labels = labels.cuda()
+                    ptclouds = ptclouds.to(args.device)
+                    labels = labels.to(args.device)
 
                     model.eval()
 
-                    logits = model(ptclouds)
-                    loss = F.cross_entropy(logits, labels)
+                    with amp.autocast():
+                        logits = model(ptclouds)
+                        loss = F.cross_entropy(logits, labels)
 
                     # 　Compute predictions
                     _, preds = torch.max(logits.detach(), dim=1, keepdim=False)
-                    pred_total.append(preds.cpu().detach())
+                    metric.update(preds, labels)
 
                     WRITER.add_scalar('Valid/loss', loss, global_iter)
                     logger.cprint(
                         '=====[Valid] Epoch: %d | Iter: %d | Loss: %.4f =====' % (epoch, i, loss.item()))
 
-            pred_total = torch.stack(pred_total, dim=0).view(-1, args.pc_npts)
-            gt_total = torch.stack(gt_total, dim=0).view(-1, args.pc_npts)
-            accuracy, mIoU, iou_perclass = metric_evaluate(pred_total, gt_total, NUM_CLASSES)
+            accuracy, mIoU, iou_perclass = metric_evaluate(metric.conf)
             logger.cprint('===== EPOCH [%d]: Accuracy: %f | mIoU: %f =====\n' % (epoch, accuracy, mIoU))
             WRITER.add_scalar('Valid/overall_accuracy', accuracy, global_iter)
             WRITER.add_scalar('Valid/meanIoU', mIoU, global_iter)
@@ -1,13 +1,14 @@
 
 import os
 import torch
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, BatchSampler, SequentialSampler
 from torch.utils.tensorboard import SummaryWriter
 
 from runs.eval import test_few_shot
-from dataloaders.loader import MyDataset, MyTestDataset, batch_test_task_collate
+from dataloaders.loader import MyDataset, MyTestDataset, MyEpisodeCacheDataset, batch_test_task_collate, \
+                               batch_test_tasks_collate, episode_worker_init_fn
 from models.proto_learner import ProtoLearner
-from utils.cuda_util import cast_cuda
+from utils.cuda_util import CUDAPrefetcher
 from utils.logger import init_logger
 
 
@@ -32,25 +33,34 @@ def train(args):
                               n_way=args.n_way, k_shot=args.k_shot, n_queries=args.n_queries,
                               phase=args.phase, mode='train',
                               num_point=args.pc_npts, pc_attribs=args.pc_attribs,
-                              pc_augm=args.pc_augm, pc_augm_config=PC_AUGMENT_CONFIG)
+                              pc_augm=args.pc_augm, pc_augm_config=PC_AUGMENT_CONFIG,
+                              block_cache_size=args.block_cache_size)
+    if args.episode_cache_size > 0:
+        TRAIN_DATASET = MyEpisodeCacheDataset(TRAIN_DATASET, args.episode_cache_size)
 
     VALID_DATASET = MyTestDataset(args.data_path, args.dataset, cvfold=args.cvfold,
                                   num_episode_per_comb=args.n_episode_test,
                                   n_way=args.n_way, k_shot=args.k_shot, n_queries=args.n_queries,
-                                  num_point=args.pc_npts, pc_attribs=args.pc_attribs)
+                                  num_point=args.pc_npts, pc_attribs=args.pc_attribs, n_workers=args.n_workers)
     VALID_CLASSES = list(VALID_DATASET.classes)
 
-    TRAIN_LOADER = DataLoader(TRAIN_DATASET, batch_size=1, collate_fn=batch_test_task_collate)
-    VALID_LOADER = DataLoader(VALID_DATASET, batch_size=1, collate_fn=batch_test_task_collate)
+    TRAIN_LOADER = DataLoader(TRAIN_DATASET, batch_size=1, collate_fn=batch_test_task_collate,
+                              num_workers=args.n_workers, pin_memory=args.device.type == 'cuda',
+                              worker_init_fn=episode_worker_init_fn)
+    valid_batched = args.eval_batch_size > 1
+    if valid_batched:
+        VALID_LOADER = DataLoader(VALID_DATASET, batch_size=None, collate_fn=batch_test_tasks_collate,
+                                  sampler=BatchSampler(SequentialSampler(VALID_DATASET), args.eval_batch_size,
+                                                       drop_last=False))
+    else:
+        VALID_LOADER = DataLoader(VALID_DATASET, batch_size=1, collate_fn=batch_test_task_collate)
 
     WRITER = SummaryWriter(log_dir=args.log_dir)
 
     # train
     best_iou = 0
-    for batch_idx, (data, sampled_classes) in enumerate(TRAIN_LOADER):
-
-        if torch.cuda.is_available():
-            data = cast_cuda(data)
+    # episodes arrive on GPU already, copied asynchronously while the previous step runs
+    for batch_idx, (data, sampled_classes) in enumerate(CUDAPrefetcher(TRAIN_LOADER, args.device)):
 
         loss, accuracy = PL.train(data)
 
@@ -60,7 +70,7 @@ def train(args):
 
         if (batch_idx+1) % args.eval_interval == 0:
 
-            valid_loss, mean_IoU = test_few_shot(VALID_LOADER, PL, logger, VALID_CLASSES)
+            valid_loss, mean_IoU = test_few_shot(VALID_LOADER, PL, logger, VALID_CLASSES, batched=valid_batched)
             logger.cprint('\n=====[VALID] Loss: %.4f | Mean IoU: %f =====\n' % (valid_loss, mean_IoU))
             WRITER.add_scalar('Valid/loss', valid_loss, batch_idx)
             WRITER.add_scalar('Valid/meanIoU', mean_IoU, batch_idx)
@@ -0,0 +1,169 @@
+""" Benchmark of mixed precision (--amp) for ProtoNet and MPTI
+
+For each precision mode, reports the time of a training step and of a test episode, the test mIoU, its delta with
+respect to fp32 and the fraction of query points predicted as in fp32. All modes share the same weights: a trained
+model with --model_checkpoint_path, random ones otherwise. Test episodes come from the test set of --data_path, or
+are random point clouds if it is not given (the mIoU is then only meaningful as a comparison between modes).
+Usage: python scripts/benchmark_amp.py --model mpti --device cuda --data_path ./datasets/S3DIS/blocks_bs1_s1 \
+                                       --model_checkpoint_path ./log_s3dis/log_mpti_S3DIS_S0_N2_K1_Att1
+"""
+import os
+import ast
+import sys
+import copy
+import time
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BASE_DIR)
+sys.path.append(ROOT_DIR)
+
+from dataloaders.loader import MyTestDataset, batch_test_task_collate
+from models.CCBR import ProtoNet
+from models.mpti import MultiPrototypeTransductiveInference
+from runs.eval import update_episode_metric
+from utils.amp_util import MixedPrecision
+from utils.checkpoint_util import load_model_checkpoint
+from utils.cuda_util import get_device, cast_device
+from utils.metric_util import ConfusionMatrix
+
+
+def random_episodes(args, n_episodes, rng):
+    """Random test episodes in the (data, sampled_classes) format of batch_test_task_collate"""
+    episodes = []
+    for _ in range(n_episodes):
+        support_x = torch.from_numpy(rng.randn(args.n_way, args.k_shot, args.pc_in_dim, args.pc_npts).astype(np.float32))
+        support_y = torch.from_numpy(rng.randint(0, 2, (args.n_way, args.k_shot, args.pc_npts)))
+        query_x = torch.from_numpy(rng.randn(args.n_way*args.n_queries, args.pc_in_dim, args.pc_npts).astype(np.float32))
+        query_y = torch.from_numpy(rng.randint(0, args.n_way+1, (args.n_way*args.n_queries, args.pc_npts)))
+        episodes.append(([support_x, support_y, query_x, query_y], np.arange(args.n_way)))
+    return episodes
+
+
+def time_train_step(model, amp, data, n_runs, device):
+    model = copy.deepcopy(model)
+    model.train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    for i in range(n_runs + 1):
+        if i == 1:
+            # the first step is a warm up
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            start = time.time()
+        with amp.autocast():
+            query_logits, loss = model(*data)
+        optimizer.zero_grad()
+        amp.backward(loss, optimizer)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - start) / n_runs
+
+
+def test(model, amp, episodes, test_classes, device):
+    """Returns the mean time per episode, the mIoU and the predictions of all the episodes"""
+    model.eval()
+    metric = ConfusionMatrix(len(test_classes) + 1)
+    preds = []
+    elapsed = 0.
+    with torch.no_grad():
+        for data, sampled_classes in episodes:
+            data = cast_device(list(data), device)
+            start = time.time()
+            with amp.autocast():
+                logits, loss = model(*data)
+            pred = logits.argmax(dim=1)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            elapsed += time.time() - start
+            update_episode_metric(metric, pred, data[-1], sampled_classes, test_classes)
+            preds.append(pred)
+    return elapsed / len(episodes), metric.mean_iou(), torch.cat(preds)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='[Benchmark] mixed precision training and inference')
+    parser.add_argument('--model', default='mpti', choices=['mpti', 'protonet'])
+    parser.add_argument('--modes', default=None, help='list of precision modes, defaults to fp16+bf16 on cuda, '
+                                                      'bf16 on cpu (fp32 is always the reference)')
+    parser.add_argument('--device', type=str, default=None)
+    parser.add_argument('--model_checkpoint_path', type=str, default=None)
+    parser.add_argument('--data_path', type=str, default=None, help='test episodes of this dataset if given')
+    parser.add_argument('--dataset', type=str, default='s3dis')
+    parser.add_argument('--cvfold', type=int, default=0)
+    parser.add_argument('--n_episodes', type=int, default=20)
+    parser.add_argument('--n_runs', type=int, default=5, help='number of timed training steps')
+    # same defaults as main.py
+    parser.add_argument('--n_way', type=int, default=2)
+    parser.add_argument('--k_shot', type=int, default=1)
+    parser.add_argument('--n_queries', type=int, default=1)
+    parser.add_argument('--pc_npts', type=int, default=2048)
+    parser.add_argument('--pc_attribs', default='xyzrgbXYZ')
+    parser.add_argument('--dgcnn_k', type=int, default=20)
+    parser.add_argument('--dgcnn_knn_chunk', type=int, default=0)
+    parser.add_argument('--dgcnn_edgeconv', default='concat', choices=['concat', 'fused'])
+    parser.add_argument('--dgcnn_static_graph', action='store_true')
+    parser.add_argument('--joint_encoding', action='store_true')
+    parser.add_argument('--edgeconv_widths', default='[[64,64], [64,64], [64,64]]')
+    parser.add_argument('--dgcnn_mlp_widths', default='[512, 256]')
+    parser.add_argument('--base_widths', default='[128, 64]')
+    parser.add_argument('--output_dim', type=int, default=64)
+    parser.add_argument('--use_attention', action='store_true')
+    parser.add_argument('--n_subprototypes', type=int, default=100)
+    parser.add_argument('--n_kmeans_iters', type=int, default=0)
+    parser.add_argument('--k_connect', type=int, default=200)
+    parser.add_argument('--sigma', type=float, default=1.)
+    parser.add_argument('--lp_solver', default='dense', choices=['dense', 'cg'])
+    parser.add_argument('--lp_iters', type=int, default=200)
+    parser.add_argument('--lp_tol', type=float, default=1e-4)
+    parser.add_argument('--knn_backend', default='faiss_flat')
+    parser.add_argument('--knn_block_size', type=int, default=4096)
+    parser.add_argument('--knn_nlist', type=int, default=0)
+    parser.add_argument('--knn_nprobe', type=int, default=8)
+    parser.add_argument('--knn_hnsw_m', type=int, default=32)
+    parser.add_argument('--knn_ef_search', type=int, default=64)
+    args = parser.parse_args()
+
+    args.edgeconv_widths = ast.literal_eval(args.edgeconv_widths)
+    args.dgcnn_mlp_widths = ast.literal_eval(args.dgcnn_mlp_widths)
+    args.base_widths = ast.literal_eval(args.base_widths)
+    args.pc_in_dim = len(args.pc_attribs)
+    args.device = get_device(args.device)
+    if args.modes is None:
+        modes = ['fp16', 'bf16'] if args.device.type == 'cuda' else ['bf16']
+    else:
+        modes = ast.literal_eval(args.modes)
+
+    torch.manual_seed(0)
+    model = MultiPrototypeTransductiveInference(args) if args.model == 'mpti' else ProtoNet(args)
+    model.to(args.device)
+    if args.model_checkpoint_path is not None:
+        model = load_model_checkpoint(model, args.model_checkpoint_path, mode='test', map_location=args.device)
+
+    if args.data_path is None:
+        episodes = random_episodes(args, args.n_episodes, np.random.RandomState(0))
+        test_classes = list(range(args.n_way))
+    else:
+        dataset = MyTestDataset(args.data_path, args.dataset, cvfold=args.cvfold,
+                                num_episode_per_comb=args.n_episodes, n_way=args.n_way, k_shot=args.k_shot,
+                                n_queries=args.n_queries, num_point=args.pc_npts, pc_attribs=args.pc_attribs,
+                                mode='test')
+        loader = DataLoader(dataset, batch_size=1, shuffle=False, collate_fn=batch_test_task_collate)
+        episodes = [episode for i, episode in zip(range(args.n_episodes), loader)]
+        test_classes = list(dataset.classes)
+
+    train_data = cast_device(list(episodes[0][0]), args.device)
+    reference = None
+    for mode in ['none'] + modes:
+        amp = MixedPrecision(mode, args.device)
+        train_seconds = time_train_step(model, amp, train_data, args.n_runs, args.device)
+        test_seconds, mean_iou, preds = test(model, amp, episodes, test_classes, args.device)
+        if reference is None:
+            reference = (train_seconds, test_seconds, mean_iou, preds)
+        print('{0:>4} | train step: {1:8.1f} ms (x{2:.2f}) | test episode: {3:8.1f} ms (x{4:.2f}) | mIoU: {5:.4f} '
+              '(delta {6:+.4f}) | same predictions: {7:.4f}'.format(
+              'fp32' if mode == 'none' else mode, train_seconds * 1000, reference[0] / train_seconds,
+              test_seconds * 1000, reference[1] / test_seconds, mean_iou, mean_iou - reference[2],
+              (preds == reference[3]).float().mean().item()))
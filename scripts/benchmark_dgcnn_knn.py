@@ -0,0 +1,81 @@
+""" Benchmark of the full vs chunked kNN of the DGCNN EdgeConv layers
+
+Reports, for each number of points, the time and peak memory of the knn search with the full (B, N, N) distance
+matrix and with blocks of chunk query points, and checks that both return the same neighbors.
+On CPU the peak memory is not measured, the size of the distance buffer is reported instead.
+Usage: python scripts/benchmark_dgcnn_knn.py --num_points [2048,8192,32768] --chunk 1024 --device cuda
+"""
+import os
+import ast
+import sys
+import time
+import torch
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BASE_DIR)
+sys.path.append(ROOT_DIR)
+
+from models.dgcnn import knn
+from utils.cuda_util import get_device
+
+
+def run_knn(x, k, chunk_size, n_runs):
+    """Returns the mean time (s), the peak memory (bytes, None on cpu) and the indices of the last run"""
+    knn(x, k, chunk_size)  # warm up
+    if x.is_cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats(x.device)
+        base_memory = torch.cuda.memory_allocated(x.device)
+    start = time.time()
+    for _ in range(n_runs):
+        idx = knn(x, k, chunk_size)
+    if x.is_cuda:
+        torch.cuda.synchronize()
+        peak_memory = torch.cuda.max_memory_allocated(x.device) - base_memory
+    else:
+        peak_memory = None
+    return (time.time() - start) / n_runs, peak_memory, idx
+
+
+def format_memory(n_bytes):
+    return '{0:9.1f} MB'.format(n_bytes / 2.**20)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='[Benchmark] full vs chunked kNN in DGCNN')
+    parser.add_argument('--num_points', default='[2048, 8192, 16384]', help='list of point counts to benchmark')
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--dim', type=int, default=64, help='feature dimension of the EdgeConv input')
+    parser.add_argument('--k', type=int, default=20, help='number of neighbors (dgcnn_k)')
+    parser.add_argument('--chunk', type=int, default=1024, help='query points per block of the chunked search')
+    parser.add_argument('--skip_full', type=int, default=0, help='skip the full search above this many points, 0 never')
+    parser.add_argument('--n_runs', type=int, default=3)
+    parser.add_argument('--device', type=str, default=None)
+    args = parser.parse_args()
+
+    device = get_device(args.device)
+    torch.manual_seed(0)
+    element_size = torch.zeros(0).element_size()
+
+    for num_points in ast.literal_eval(args.num_points):
+        x = torch.randn(args.batch_size, args.dim, num_points, device=device)
+        full_idx = None
+        for chunk_size in [0, args.chunk]:
+            if chunk_size == 0 and 0 < args.skip_full < num_points:
+                continue
+            seconds, peak_memory, idx = run_knn(x, args.k, chunk_size, args.n_runs)
+            if peak_memory is None:
+                rows = num_points if chunk_size == 0 else min(chunk_size, num_points)
+                memory = 'distance buffer ' + format_memory(args.batch_size * rows * num_points * element_size)
+            else:
+                memory = 'peak ' + format_memory(peak_memory)
+            if chunk_size == 0:
+                full_idx = idx
+                check = ''
+            elif full_idx is None:
+                check = ''
+            else:
+                check = ' | same neighbors: {0:.4f}'.format((idx == full_idx).float().mean().item())
+            print('num_points: {0} | {1:>10} | {2:8.1f} ms | {3}{4}'.format(
+                  num_points, 'full' if chunk_size == 0 else 'chunk=%d' % chunk_size, seconds * 1000, memory, check))
@@ -0,0 +1,98 @@
+""" Validation and benchmark of the fused EdgeConv of DGCNN against the concat implementation
+
+Both encoders share the same (randomly initialized, then perturbed batch norm statistics) parameters. Reports the max
+difference of the outputs (and of the gradients in train mode), the time and, on CUDA, the peak memory of the forward.
+Each layer matches to rounding, but in float32 the rounding can flip near-tied neighbors of the following layers,
+use --dtype float64 for a tight check of the whole encoder.
+Usage: python scripts/benchmark_edgeconv.py --num_points [2048,8192] --chunk 1024 --device cuda
+"""
+import os
+import ast
+import sys
+import time
+import torch
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BASE_DIR)
+sys.path.append(ROOT_DIR)
+
+from models.dgcnn import DGCNN
+from utils.cuda_util import get_device
+
+
+def build_encoders(args, device):
+    edgeconv_widths = ast.literal_eval(args.edgeconv_widths)
+    mlp_widths = ast.literal_eval(args.dgcnn_mlp_widths)
+    encoders = {}
+    for edgeconv in ['concat', 'fused']:
+        encoders[edgeconv] = DGCNN(edgeconv_widths, mlp_widths, args.pc_in_dim, k=args.dgcnn_k,
+                                   knn_chunk_size=args.chunk, edgeconv=edgeconv).to(device, args.dtype)
+    # non-trivial batch norm statistics so that eval mode is not an identity
+    for module in encoders['concat'].modules():
+        if isinstance(module, (torch.nn.BatchNorm1d, torch.nn.BatchNorm2d)):
+            module.running_mean.uniform_(-0.5, 0.5)
+            module.running_var.uniform_(0.5, 2.)
+            module.weight.data.uniform_(0.5, 1.5)
+            module.bias.data.uniform_(-0.5, 0.5)
+    encoders['fused'].load_state_dict(encoders['concat'].state_dict())
+    return encoders
+
+
+def run_forward(encoder, x, train, n_runs):
+    """Returns the mean time (s), the peak memory (bytes, None on cpu), the outputs and the input gradients"""
+    encoder.train(train)
+    if x.is_cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats(x.device)
+        base_memory = torch.cuda.memory_allocated(x.device)
+    start = time.time()
+    for _ in range(n_runs):
+        x_in = x.clone().requires_grad_(train)
+        with torch.set_grad_enabled(train):
+            edgeconv_feat, out = encoder(x_in)
+            if train:
+                out.sum().backward()
+    if x.is_cuda:
+        torch.cuda.synchronize()
+        peak_memory = torch.cuda.max_memory_allocated(x.device) - base_memory
+    else:
+        peak_memory = None
+    return (time.time() - start) / n_runs, peak_memory, out.detach(), x_in.grad
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='[Benchmark] fused vs concat EdgeConv in DGCNN')
+    parser.add_argument('--num_points', default='[2048, 8192]', help='list of point counts to benchmark')
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--pc_in_dim', type=int, default=9)
+    parser.add_argument('--dgcnn_k', type=int, default=20)
+    parser.add_argument('--edgeconv_widths', default='[[64,64], [64,64], [64,64]]')
+    parser.add_argument('--dgcnn_mlp_widths', default='[512, 256]')
+    parser.add_argument('--chunk', type=int, default=1024,
+                        help='query points per block of the knn and of the fused edgeconv in eval mode')
+    parser.add_argument('--n_runs', type=int, default=3)
+    parser.add_argument('--dtype', default='float32', choices=['float32', 'float64'])
+    parser.add_argument('--device', type=str, default=None)
+    args = parser.parse_args()
+    args.dtype = getattr(torch, args.dtype)
+
+    device = get_device(args.device)
+    torch.manual_seed(0)
+    encoders = build_encoders(args, device)
+
+    for num_points in ast.literal_eval(args.num_points):
+        x = torch.randn(args.batch_size, args.pc_in_dim, num_points, device=device, dtype=args.dtype)
+        for train in [False, True]:
+            results = {name: run_forward(encoder, x, train, args.n_runs) for name, encoder in encoders.items()}
+            for name, (seconds, peak_memory, out, grad) in results.items():
+                memory = '' if peak_memory is None else ' | peak {0:9.1f} MB'.format(peak_memory / 2.**20)
+                print('num_points: {0} | {1:>5} | {2:>6} | {3:8.1f} ms{4}'.format(
+                      num_points, 'train' if train else 'eval', name, seconds * 1000, memory))
+            diff = (results['fused'][2] - results['concat'][2]).abs().max().item()
+            scale = results['concat'][2].abs().max().item()
+            line = '    max output diff: {0:.3e} (max abs output {1:.3e})'.format(diff, scale)
+            if train:
+                grad_diff = (results['fused'][3] - results['concat'][3]).abs().max().item()
+                line += ' | max input grad diff: {0:.3e}'.format(grad_diff)
+            print(line)
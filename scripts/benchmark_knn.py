@@ -0,0 +1,70 @@
+""" Benchmark of the kNN backends used to build the MPTI graph
+
+Reports, for each backend and number of nodes, the search time and the recall@k against the exact neighbors.
+Nodes are drawn from a mixture of gaussians to mimic clustered point features.
+Usage: python scripts/benchmark_knn.py --num_nodes [2048,4096,8192] --k 200 --device cuda
+"""
+import os
+import ast
+import sys
+import time
+import numpy as np
+import torch
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BASE_DIR)
+sys.path.append(ROOT_DIR)
+
+from models.knn_search import KNN_BACKENDS, TorchKNN, FaissFlatKNN, FaissIVFKNN, FaissHNSWKNN
+from utils.cuda_util import get_device
+
+
+def make_nodes(num_nodes, dim, n_clusters, rng):
+    centers = rng.randn(n_clusters, dim).astype(np.float32)
+    assignments = rng.randint(0, n_clusters, num_nodes)
+    return centers[assignments] + 0.3 * rng.randn(num_nodes, dim).astype(np.float32)
+
+
+def recall(idx, exact_idx):
+    """Fraction of the exact neighbors retrieved by idx, rows are compared as sets"""
+    hits = sum(len(np.intersect1d(a, b, assume_unique=True)) for a, b in zip(idx, exact_idx))
+    return hits / float(exact_idx.size)
+
+
+def time_search(backend, x, k, n_runs):
+    backend.search(x, k)  # warm up
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(n_runs):
+        sq_dist, idx = backend.search(x, k)
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    return (time.time() - start) / n_runs, idx
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='[Benchmark] kNN backends for MPTI graph construction')
+    parser.add_argument('--num_nodes', default='[2048, 4096, 8192]', help='list of graph sizes to benchmark')
+    parser.add_argument('--dim', type=int, default=192, help='node feature dimension')
+    parser.add_argument('--k', type=int, default=200, help='number of neighbors (k_connect)')
+    parser.add_argument('--n_clusters', type=int, default=50)
+    parser.add_argument('--n_runs', type=int, default=3)
+    parser.add_argument('--device', type=str, default=None)
+    parser.add_argument('--knn_nprobe', type=int, default=8)
+    parser.add_argument('--knn_ef_search', type=int, default=64)
+    args = parser.parse_args()
+
+    device = get_device(args.device)
+    rng = np.random.RandomState(0)
+    backends = {'torch': TorchKNN(), 'faiss_flat': FaissFlatKNN(), 'faiss_ivf': FaissIVFKNN(nprobe=args.knn_nprobe),
+                'faiss_hnsw': FaissHNSWKNN(ef_search=args.knn_ef_search)}
+
+    for num_nodes in ast.literal_eval(args.num_nodes):
+        x = torch.from_numpy(make_nodes(num_nodes, args.dim, args.n_clusters, rng)).to(device)
+        exact_idx = FaissFlatKNN().search(x, args.k + 1)[1].cpu().numpy()
+        for name in KNN_BACKENDS:
+            seconds, idx = time_search(backends[name], x, args.k + 1, args.n_runs)
+            print('num_nodes: {0} | {1:>10} | {2:8.1f} ms | recall@{3}: {4:.4f}'.format(
+                  num_nodes, name, seconds * 1000, args.k, recall(idx.cpu().numpy(), exact_idx)))
@@ -0,0 +1,59 @@
+""" Micro-benchmark of the query ground-truth relabeling in the episode generator
+
+Compares the former per-point python loop with the LUT-based remap_labels, reporting episodes/sec
+of the relabeling stage (n_way*n_queries query clouds per episode).
+Usage: python scripts/benchmark_relabel.py --n_way 2 --n_queries 1
+"""
+import os
+import ast
+import sys
+import time
+import numpy as np
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BASE_DIR)
+sys.path.append(ROOT_DIR)
+
+from dataloaders.loader import remap_labels
+
+
+def relabel_loop(labels, sampled_classes):
+    """The per-point relabeling used by sample_pointcloud before remap_labels"""
+    sampled_classes = list(sampled_classes)
+    groundtruth = np.zeros_like(labels)
+    for i, label in enumerate(labels):
+        if label in sampled_classes:
+            groundtruth[i] = sampled_classes.index(label)+1
+    return groundtruth
+
+
+def episodes_per_sec(relabel_fn, episodes, sampled_classes):
+    start = time.time()
+    for query_labels in episodes:
+        for labels in query_labels:
+            relabel_fn(labels, sampled_classes)
+    return len(episodes) / (time.time() - start)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='[Benchmark] Query ground-truth relabeling')
+    parser.add_argument('--n_way', type=int, default=2)
+    parser.add_argument('--n_queries', type=int, default=1)
+    parser.add_argument('--n_classes', type=int, default=13, help='number of classes in the dataset')
+    parser.add_argument('--n_episodes', type=int, default=50)
+    parser.add_argument('--num_points', default='[2048, 4096]', help='list of points per cloud to benchmark')
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    sampled_classes = list(rng.choice(args.n_classes, args.n_way, replace=False))
+    for num_point in ast.literal_eval(args.num_points):
+        episodes = [[rng.randint(0, args.n_classes, num_point) for _ in range(args.n_way*args.n_queries)]
+                    for _ in range(args.n_episodes)]
+        for labels in episodes[0]:
+            assert np.array_equal(relabel_loop(labels, sampled_classes), remap_labels(labels, sampled_classes))
+
+        loop_eps = episodes_per_sec(relabel_loop, episodes, sampled_classes)
+        lut_eps = episodes_per_sec(remap_labels, episodes, sampled_classes)
+        print('num_points: {0} | loop: {1:.1f} episodes/sec | lut: {2:.1f} episodes/sec | speedup: {3:.1f}x'.format(
+              num_point, loop_eps, lut_eps, lut_eps / loop_eps))
@@ -7,6 +7,7 @@ import ast
 import argparse
 import sys
 import codecs
+from utils.cuda_util import get_device
 sys.stdout = codecs.getwriter("utf-8")(sys.stdout.detach())
 
 
@@ -15,8 +16,8 @@ if __name__ == '__main__':
 
     #data
     parser.add_argument('--phase', type=str, default='graphtrain', choices=['pretrain', 'finetune',
-                                                                            '2CBRtrain', '2CBReval',
-                                                                            'mptitrain', 'mptieval'])
+                                                                            '2CBRtrain', '2CBReval', '2CBRinfer',
+                                                                            'mptitrain', 'mptieval', 'mptiinfer'])
     parser.add_argument('--dataset', type=str, default='s3dis', help='Dataset name: s3dis|scannet')
     parser.add_argument('--cvfold', type=int, default=0, help='Fold left-out for testing in leave-one-out setting'
                                                               'Options:{0,1}')
@@ -32,6 +33,11 @@ if __name__ == '__main__':
                         help='iteration/epoch inverval to evaluate model')
 
     #optimization
+    parser.add_argument('--device', type=str, default=None,
+                        help='Device to run on: cpu|cuda|cuda:<id>, defaults to cuda when it is available')
+    parser.add_argument('--amp', default='none', choices=['none', 'fp16', 'bf16'],
+                        help='Mixed precision training/inference: fp16 autocast with loss scaling (cuda only) or bf16 '
+                             'autocast (cuda and cpu); knn distances and label propagation stay in fp32')
     parser.add_argument('--batch_size', type=int, default=32, help='Number of samples/tasks in one batch')
     parser.add_argument('--n_workers', type=int, default=16, help='number of workers to load data')
     parser.add_argument('--n_iters', type=int, default=30000, help='number of iterations/epochs to train')
@@ -52,6 +58,8 @@ if __name__ == '__main__':
     parser.add_argument('--n_queries', type=int, default=1, help='Number of queries for each class')
     parser.add_argument('--n_episode_test', type=int, default=100,
                         help='Number of episode per configuration during testing')
+    parser.add_argument('--eval_batch_size', type=int, default=1,
+                        help='Number of test episodes encoded in one forward pass (ProtoNet only)')
 
     # Point cloud processing
     parser.add_argument('--pc_npts', type=int, default=2048, help='Number of input points for PointNet.')
@@ -67,9 +75,31 @@ if __name__ == '__main__':
                         help='Training augmentation: Probability of mirroring about x or y axes')
     parser.add_argument('--pc_augm_jitter', type=int, default=1,
                         help='Training augmentation: Bool, Gaussian jittering of all attributes')
+    parser.add_argument('--block_cache_size', type=int, default=0,
+                        help='Number of decoded blocks kept in the LRU of each data loader, 0 disables caching')
+    parser.add_argument('--episode_cache_size', type=int, default=0,
+                        help='Number of pre-generated training episodes replayed with online augmentation, '
+                             '0 samples every episode from the blocks')
+    parser.add_argument('--support_cache_size', type=int, default=0,
+                        help='Number of encoded support sets kept by the ProtoNet learner at test time, so that '
+                             'queries against a recently seen support set only encode the queries; 0 disables it')
 
     # feature extraction network configuration
     parser.add_argument('--dgcnn_k', type=int, default=20, help='Number of nearest neighbors in Edgeconv')
+    parser.add_argument('--dgcnn_knn_chunk', type=int, default=0,
+                        help='Query points per block of the Edgeconv knn search (and of the fused Edgeconv at '
+                             'evaluation), bounding its memory to chunk x num_points per cloud; 0 computes the full '
+                             'num_points x num_points distances')
+    parser.add_argument('--dgcnn_edgeconv', default='concat', choices=['concat', 'fused'],
+                        help='Edgeconv implementation: concat builds the (2C, N, K) edge features, fused applies the '
+                             'first conv on the point features before gathering the neighbors (about K times less '
+                             'memory for the first layer)')
+    parser.add_argument('--dgcnn_static_graph', action='store_true',
+                        help='Compute the Edgeconv knn graph once on the xyz coordinates and share it across layers, '
+                             'instead of a dynamic graph on the features of each layer (needs xyz in pc_attribs)')
+    parser.add_argument('--joint_encoding', action='store_true',
+                        help='Encode the support and query clouds of an episode in one batch also in training '
+                             '(always done at evaluation), BatchNorm statistics are then shared by both')
     parser.add_argument('--edgeconv_widths', default='[[64,64], [64,64], [64,64]]', help='DGCNN Edgeconv widths')
     parser.add_argument('--dgcnn_mlp_widths', default='[512, 256]', help='DGCNN MLP (following stacked Edgeconv) widths')
     parser.add_argument('--base_widths', default='[128, 64]', help='BaseLearner widths')
@@ -84,9 +114,40 @@ if __name__ == '__main__':
     # MPTI configuration
     parser.add_argument('--n_subprototypes', type=int, default=100,
                         help='Number of prototypes for each class in support set')
+    parser.add_argument('--n_kmeans_iters', type=int, default=0,
+                        help='Number of k-means iterations refining the FPS clusters of the multiple prototypes')
     parser.add_argument('--k_connect', type=int, default=200,
                         help='Number of nearest neighbors to construct local-constrained affinity matrix')
     parser.add_argument('--sigma', type=float, default=1., help='hyeprparameter in gaussian similarity function')
+    parser.add_argument('--lp_solver', default='dense', choices=['dense', 'cg'],
+                        help='Label propagation solver: dense inverse of the full affinity matrix, or conjugate '
+                             'gradient on the sparse kNN graph (memory linear in the number of points)')
+    parser.add_argument('--lp_iters', type=int, default=200, help='Maximum number of conjugate gradient iterations')
+    parser.add_argument('--lp_tol', type=float, default=1e-4, help='Relative residual tolerance of conjugate gradient')
+    parser.add_argument('--knn_backend', default='faiss_flat',
+                        choices=['faiss_flat', 'torch', 'faiss_ivf', 'faiss_hnsw'],
+                        help='kNN search used to build the MPTI graph: exact faiss/torch (on device) or approximate '
+                             'faiss IVF/HNSW')
+    parser.add_argument('--knn_block_size', type=int, default=4096, help='Query rows per block of the torch kNN')
+    parser.add_argument('--knn_nlist', type=int, default=0, help='Number of IVF lists, 0 picks 4*sqrt(num_nodes)')
+    parser.add_argument('--knn_nprobe', type=int, default=8, help='Number of IVF lists visited per query')
+    parser.add_argument('--knn_hnsw_m', type=int, default=32, help='Number of neighbors per node in the HNSW graph')
+    parser.add_argument('--knn_ef_search', type=int, default=64, help='HNSW search candidate list size')
+
+    # whole-room inference (2CBRinfer/mptiinfer)
+    parser.add_argument('--room_path', type=str, default=None,
+                        help='Room .npy file(s) to segment (comma separated), as written by collect_s3dis_data.py '
+                             'or collect_scannet_data.py')
+    parser.add_argument('--support_classes', default='[]', help='Labels of the n_way support classes')
+    parser.add_argument('--support_blocks', default='[]',
+                        help='For each support class, the k_shot blocks of data_path used as support, '
+                             'e.g. "[[\'Area_1_office_1_block_3\'], [\'Area_1_office_2_block_0\']]"')
+    parser.add_argument('--infer_batch_size', type=int, default=8, help='Number of block clouds per encoder pass')
+    parser.add_argument('--infer_block_size', type=float, default=1., help='Size of the blocks tiling the room')
+    parser.add_argument('--infer_stride', type=float, default=1., help='Stride of the blocks tiling the room')
+    parser.add_argument('--infer_sampling', default='sample', choices=['sample', 'chunk'],
+                        help='sample: one cloud of pc_npts points per block, chunk: split every block into clouds '
+                             'of pc_npts points covering all of its points')
 
     args = parser.parse_args()
 
@@ -94,6 +155,16 @@ if __name__ == '__main__':
     args.dgcnn_mlp_widths = ast.literal_eval(args.dgcnn_mlp_widths)
     args.base_widths = ast.literal_eval(args.base_widths)
     args.pc_in_dim = len(args.pc_attribs)
+    if args.dgcnn_static_graph and not args.pc_attribs.startswith('xyz'):
+        raise ValueError('The static Edgeconv graph is built on xyz, which must come first in pc_attribs (%s)'
+                         % args.pc_attribs)
+    args.device = get_device(args.device)
+    if args.phase=='2CBRinfer' or args.phase=='mptiinfer':
+        from runs.infer import parse_infer_args
+        try:
+            parse_infer_args(args)
+        except ValueError as e:
+            parser.error(str(e))
 
     # Start trainer for pre-train, proto-train, proto-eval, mpti-train, mpti-test
     if args.phase=='mptitrain':
@@ -113,6 +184,10 @@ if __name__ == '__main__':
         args.log_dir = args.model_checkpoint_path
         from runs.eval import eval
         eval(args)
+    elif args.phase=='2CBRinfer' or args.phase=='mptiinfer':
+        args.log_dir = args.model_checkpoint_path
+        from runs.infer import infer
+        infer(args)
     elif args.phase=='pretrain':
         args.log_dir = args.save_path + 'log_pretrain_%s_S%d' % (args.dataset, args.cvfold)
         from runs.pre_train import pretrain
@@ -0,0 +1,67 @@
+""" Mixed precision util functions
+
+"""
+import torch
+
+AMP_DTYPES = {'none': None, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+class NoAutocast(object):
+    """No-op context replacing autocast when mixed precision is off or not supported by the installed torch"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def amp_available():
+    """torch.autocast and torch.amp.GradScaler are needed for --amp fp16/bf16 (torch >= 2.3)"""
+    return hasattr(torch, 'autocast') and hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler')
+
+
+class MixedPrecision(object):
+    """
+    Opt-in automatic mixed precision (--amp): autocast() wraps the forward passes and backward() replaces
+    loss.backward(); optimizer.step(). fp16 needs a CUDA device and scales the loss with a GradScaler, bf16 has the
+    range of fp32 and runs on CPU as well, without loss scaling. With 'none' both are the plain fp32 versions and no
+    torch AMP API is used, so that older torch versions keep working.
+    """
+    def __init__(self, mode, device):
+        if mode not in AMP_DTYPES:
+            raise ValueError('Wrong mixed precision mode (%s)! Option:none/fp16/bf16' % mode)
+        if mode != 'none' and not amp_available():
+            raise ValueError('Mixed precision (%s) needs torch.autocast and torch.amp.GradScaler, not available in '
+                             'torch %s. Use --amp none or upgrade torch' % (mode, torch.__version__))
+        if mode == 'fp16' and device.type != 'cuda':
+            raise ValueError('fp16 mixed precision needs a CUDA device, use bf16 on %s' % device.type)
+        self.mode = mode
+        self.device = device
+        self.dtype = AMP_DTYPES[mode]
+        self.scaler = torch.amp.GradScaler(device.type) if mode == 'fp16' else None
+
+    def autocast(self):
+        if self.dtype is None:
+            return NoAutocast()
+        return torch.autocast(device_type=self.device.type, dtype=self.dtype)
+
+    def backward(self, loss, optimizer):
+        """Backward the (scaled) loss and update the parameters, skipping the steps with inf/nan gradients"""
+        if self.scaler is None:
+            loss.backward()
+            optimizer.step()
+            return
+        self.scaler.scale(loss).backward()
+        self.scaler.step(optimizer)
+        self.scaler.update()
+
+
+def fp32(x):
+    """
+    Context disabling autocast on the device of x, for the numerically sensitive parts (knn distances, matrix inverse).
+    The tensors used inside have to be cast with .float() since they may come out of an autocast region in half.
+    Without torch.autocast nothing can be running in half precision, so this is a no-op.
+    """
+    if not hasattr(torch, 'autocast'):
+        return NoAutocast()
+    return torch.autocast(device_type=x.device.type, enabled=False)
@@ -6,12 +6,13 @@ import os
 import torch
 
 
-def load_pretrain_checkpoint(model, pretrain_checkpoint_path):
+def load_pretrain_checkpoint(model, pretrain_checkpoint_path, map_location=None):
     # load pretrained model for point cloud encoding
     model_dict = model.state_dict()
     if pretrain_checkpoint_path is not None:
         print('Load encoder module from pretrained checkpoint...')
-        pretrained_dict = torch.load(os.path.join(pretrain_checkpoint_path, 'checkpoint.tar'))['params']
+        pretrained_dict = torch.load(os.path.join(pretrain_checkpoint_path, 'checkpoint.tar'),
+                                     map_location=map_location)['params']
         pretrained_dict = {'encoder.' + k: v for k, v in pretrained_dict.items()}
         pretrained_dict = {k: v for k, v in pretrained_dict.items() if k in model_dict}
         model_dict.update(pretrained_dict)
@@ -22,9 +23,9 @@ def load_pretrain_checkpoint(model, pretrain_checkpoint_path):
     return model
 
 
-def load_model_checkpoint(model, model_checkpoint_path, optimizer=None, mode='test'):
+def load_model_checkpoint(model, model_checkpoint_path, optimizer=None, mode='test', map_location=None):
     try:
-        checkpoint = torch.load(os.path.join(model_checkpoint_path, 'checkpoint.tar'))
+        checkpoint = torch.load(os.path.join(model_checkpoint_path, 'checkpoint.tar'), map_location=map_location)
         start_iter = checkpoint['iteration']
         start_iou = checkpoint['IoU']
     except:
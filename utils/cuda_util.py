@@ -2,10 +2,65 @@
 
 """
 
-def cast_cuda(input):
+import torch
+
+
+def get_device(device=None):
+    """Resolve the --device option (e.g. cpu|cuda|cuda:1), defaults to cuda when it is available"""
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    return torch.device(device)
+
+
+def cast_device(input, device, non_blocking=False):
     if type(input) == type([]):
         for i in range(len(input)):
-            input[i] = cast_cuda(input[i])
+            input[i] = cast_device(input[i], device, non_blocking=non_blocking)
     else:
-        return input.cuda()
-    return input
\ No newline at end of file
+        return input.to(device, non_blocking=non_blocking)
+    return input
+
+
+def cast_cuda(input, non_blocking=False):
+    return cast_device(input, 'cuda', non_blocking=non_blocking)
+
+
+class CUDAPrefetcher(object):
+    """
+    Wrap an episode dataloader yielding (data, sampled_classes) and copy the next episode to GPU on a side stream,
+    so the host-to-device copy overlaps with the current training step. Use with pin_memory=True in the dataloader.
+    On a non-CUDA device the episodes are simply moved to that device.
+    """
+    def __init__(self, loader, device=None):
+        self.loader = loader
+        self.device = get_device(device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def preload(self, loader_iter, stream):
+        try:
+            data, sampled_classes = next(loader_iter)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(stream):
+            data = cast_device(data, self.device, non_blocking=True)
+        return data, sampled_classes
+
+    def __iter__(self):
+        if self.device.type != 'cuda':
+            for data, sampled_classes in self.loader:
+                yield cast_device(data, self.device), sampled_classes
+            return
+
+        stream = torch.cuda.Stream()
+        loader_iter = iter(self.loader)
+        next_batch = self.preload(loader_iter, stream)
+        while next_batch is not None:
+            torch.cuda.current_stream().wait_stream(stream)
+            data, sampled_classes = next_batch
+            for tensor in data:
+                # the tensors were allocated on the side stream but are consumed on the current one
+                tensor.record_stream(torch.cuda.current_stream())
+            next_batch = self.preload(loader_iter, stream)
+            yield data, sampled_classes
\ No newline at end of file
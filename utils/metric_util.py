@@ -0,0 +1,75 @@
+""" Util functions for segmentation metrics
+
+All metrics are derived from one confusion matrix, conf[gt, pred] = number of points of class gt predicted as pred.
+"""
+import numpy as np
+import torch
+
+
+def confusion_matrix(pred, gt, num_classes):
+    """
+    Count the (gt, pred) pairs of integer labels with a single bincount.
+    Accepts np arrays or torch tensors, tensors are counted on their own device.
+    :param pred: predicted labels in [0, num_classes), any shape
+    :param gt: ground-truth labels in [0, num_classes), same number of elements as pred
+    :return: (num_classes, num_classes) confusion matrix, rows are ground truth and columns are predictions
+    """
+    if torch.is_tensor(gt):
+        inds = gt.reshape(-1).long() * num_classes + pred.reshape(-1).long()
+        return torch.bincount(inds, minlength=num_classes**2).view(num_classes, num_classes)
+    inds = np.asarray(gt).reshape(-1).astype(np.int64) * num_classes + np.asarray(pred).reshape(-1).astype(np.int64)
+    return np.bincount(inds, minlength=num_classes**2).reshape(num_classes, num_classes)
+
+
+def confusion_metrics(conf):
+    """
+    :param conf: (num_classes, num_classes) confusion matrix, np array or tensor
+    :return: overall accuracy (scalar) and per-class IoU, precision and recall (np arrays of shape (num_classes,)),
+             classes without any gt/predicted point get nan
+    """
+    if torch.is_tensor(conf):
+        conf = conf.cpu().numpy()
+    conf = conf.astype(np.float64)
+    true_positive = np.diag(conf)
+    gt_count = conf.sum(axis=1)
+    positive_count = conf.sum(axis=0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        oa = true_positive.sum() / conf.sum()
+        iou = true_positive / (gt_count + positive_count - true_positive)
+        precision = true_positive / positive_count
+        recall = true_positive / gt_count
+    return oa, iou, precision, recall
+
+
+class ConfusionMatrix(object):
+    """
+    Streaming confusion matrix: update() adds the counts of one batch of predictions, so that predictions do not
+    have to be kept around until the end of the evaluation. The counts stay on the device of the inputs.
+    """
+    def __init__(self, num_classes):
+        self.num_classes = num_classes
+        self.conf = None
+
+    def update(self, pred, gt):
+        conf = confusion_matrix(pred, gt, self.num_classes)
+        if self.conf is None:
+            self.conf = conf
+        else:
+            self.conf += conf
+
+    def metrics(self):
+        """Overall accuracy and per-class IoU, precision and recall, see confusion_metrics"""
+        if self.conf is None:
+            return confusion_metrics(np.zeros((self.num_classes, self.num_classes), dtype=np.int64))
+        return confusion_metrics(self.conf)
+
+    def mean_iou(self, first_class=1, skip_missing=False):
+        """
+        Mean IoU over the classes [first_class, num_classes), by default class 0 (background) is left out.
+        :param skip_missing: ignore the classes without any gt/predicted point so far, for running estimates
+        """
+        iou = self.metrics()[1][first_class:]
+        if skip_missing:
+            iou = iou[~np.isnan(iou)]
+        return iou.mean() if len(iou) > 0 else float('nan')